@@ -1,4 +1,5 @@
 import argparse
+import functools
 import importlib.util
 import os
 import shutil
@@ -35,29 +36,37 @@ CFLAGS_OLD = os.environ.get("CFLAGS", "")
 CXXFLAGS_OLD = os.environ.get("CFLAGS", "")
 LDFLAGS_OLD = os.environ.get("CFLAGS", "")
 
-def get_app_name():
-    """Get app name from pyproject.toml"""
-    if os.path.exists("pyproject.toml"):
+@functools.lru_cache(None)
+def load_pyproject():
+    """Load and parse pyproject.toml only once, prefer faster rtoml if its installed"""
+    try:
         with open("pyproject.toml", "rb") as f:
-            data = tomllib.load(f)
-        if "project" in data and "version" in data["project"]:
-            return str(data["project"]["name"])
-        print("App name not specified in pyproject.toml", file=sys.stderr)
+            text = f.read().decode("utf-8")
+    except FileNotFoundError:
+        print("pyproject.toml file not found", file=sys.stderr)
         sys.exit(1)
-    print("pyproject.toml file not found", file=sys.stderr)
+    try:
+        import rtoml
+    except ImportError:
+        return tomllib.loads(text)
+    return rtoml.loads(text)
+
+
+def get_app_name():
+    """Get app name from pyproject.toml"""
+    data = load_pyproject()
+    if "project" in data and "name" in data["project"]:
+        return str(data["project"]["name"])
+    print("App name not specified in pyproject.toml", file=sys.stderr)
     sys.exit(1)
 
 
 def get_version_number():
     """Get version number from pyproject.toml"""
-    if os.path.exists("pyproject.toml"):
-        with open("pyproject.toml", "rb") as f:
-            data = tomllib.load(f)
-        if "project" in data and "version" in data["project"]:
-            return str(data["project"]["version"])
-        print("Version not specified in pyproject.toml", file=sys.stderr)
-        sys.exit(1)
-    print("pyproject.toml file not found", file=sys.stderr)
+    data = load_pyproject()
+    if "project" in data and "version" in data["project"]:
+        return str(data["project"]["version"])
+    print("Version not specified in pyproject.toml", file=sys.stderr)
     sys.exit(1)
 
 
@@ -189,16 +198,15 @@ def force_ujson():
 def build_third_party_licenses(exclude=[]):
     """Collect and build all lincenses found in venv into THIRD_PARTY_LICENSES.txt file"""
     fprint("Building list of third party licenses")
-    subprocess.run(["uv", "pip", "install", "pip-licenses"], check=True)
+    # --with installs pip-licenses in temporary environment, so venv is not modified
     command = [
-        "uv", "run", "pip-licenses",
-        "--ignore-packages " + " ".joind(exclude),
+        "uv", "run", "--with", "pip-licenses", "pip-licenses",
+        "--ignore-packages", *exclude,
         "--format=plain-vertical",
         "--no-license-path",
         "--output-file=THIRD_PARTY_LICENSES.txt",
     ]
     subprocess.run(command, check=True)
-    subprocess.run(["uv", "pip", "uninstall", "pip-licenses", "prettytable", "wcwidth"], check=True)
 
 
 def setup_compiler(clang, clear=False, overwrite=False, cflags=[], ldflags=[], cxxflags=[]):
@@ -309,7 +317,7 @@ def build_with_nuitka(onedir, clang, mingw, print_cmd=False):
     elif sys.platform == "darwin":
         options = [
             f"--macos-app-name={PKGNAME}",
-            f"--macos-app-version={get_version_number()}",
+            f"--macos-app-version={PKGVER}",
             "--macos-app-protected-resource=NSMicrophoneUsageDescription:Microphone access for recording voice message.",
         ]
 
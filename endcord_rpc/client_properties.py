@@ -1,11 +1,15 @@
 import base64
-import json
 import os
 import re
 import subprocess
 import sys
 import uuid
 
+try:
+    import orjson as json
+except ImportError:
+    import json
+
 # default client properties
 CLIENT_BUILD_NUMBER = None   # should only affect experimental features availability
 CLIENT_VERSION = "0.0.115"
@@ -16,6 +20,19 @@ WINDOWS_UA_STRING = "Windows NT %VER; Win64; x64"
 MACOS_UA_STRING = "Machintos; Intel Mac OS X %VER"
 WINDOWS_VER = 10.0
 MACOS_VER = 15.3
+# one alternative per browser, each with single named group, ordered by priority below
+BROWSER_VERSION_RE = re.compile(
+    r"Version/(?P<safari>[\d\.]+).*Safari/|"
+    r"Electron/(?P<electron>[\d\.]+)|"
+    r"Chrome/(?P<chrome>[\d\.]+)|"
+    r"Trident/.*rv:(?P<trident>[\d\.]+)|"
+    r"Opera/(?P<opera>[\d\.]+)|"
+    r"Firefox/(?P<firefox>[\d\.]+)",
+)
+BROWSER_PRIORITY = ("safari", "electron", "chrome", "trident", "opera", "firefox")
+CLIENT_VERSION_RE = re.compile(r"discord/([\d\.]+)")
+LAUNCH_SIGNATURE_BITS = 0b00000000100000000001000000010000000010000001000000001000000000000010000010000001000000000100000000000001000000000000100000000000
+LAUNCH_SIGNATURE_MASK = ~LAUNCH_SIGNATURE_BITS & ((1 << 128) - 1)
 
 if sys.platform == "linux":
     operating_system = "Linux"
@@ -33,12 +50,31 @@ if locale:
 else:
     system_locale = "en_US"
 
+# these wont change while running, so get them only once
+os_arch = "x64"
+if sys.platform == "linux":
+    os_version = os.uname().release   # same as uname -r
+elif sys.platform == "win32":
+    win_ver = sys.getwindowsversion()
+    os_version = f"{win_ver.major}.{win_ver.minor}.{win_ver.build}"
+elif sys.platform == "darwin":
+    output = subprocess.check_output(["sw_vers"], text=True)
+    os_version = output.split("\n")[1].split(":\t")[1]
+    os_arch = "arm64"   # guessing
+else:
+    os_version = ""
+if sys.platform == "linux":
+    window_manager = os.environ.get("XDG_CURRENT_DESKTOP", "unknown") + "," + os.environ.get("GDMSESSION", "unknown")
+else:
+    window_manager = None
+
 
 def get_anonymous_properties():
     """
     Get anonymous client properties which might look more suspicious to discord.
     This is approximately what web client sends.
     """
+    launch_signature, client_launch_id, client_heartbeat_session_id = generate_client_ids()
     data = {
         "os": operating_system,
         "browser": "Mozilla",
@@ -55,12 +91,12 @@ def get_anonymous_properties():
         "client_build_number": CLIENT_BUILD_NUMBER,
         "client_event_source": None,
         "has_client_mods": False,
-        "launch_signature": generate_launch_signature(),
-        "client_launch_id": str(uuid.uuid4()),
-        "client_heartbeat_session_id": str(uuid.uuid4()),   # used for persisted analytics heartbeat
+        "launch_signature": launch_signature,
+        "client_launch_id": client_launch_id,
+        "client_heartbeat_session_id": client_heartbeat_session_id,   # used for persisted analytics heartbeat
     }
 
-    user_agent = adjust_user_agent_os(USER_AGENT_WEB, sys.platform, None)
+    user_agent = adjust_user_agent_os(USER_AGENT_WEB, None)
 
     return add_user_agent(data, user_agent)
 
@@ -70,26 +106,15 @@ def get_default_properties():
     Get default client properties which might look less suspicious to discord.
     This is approximately what desktop client sends.
     """
-    arch = "x64"
-    if sys.platform == "linux":
-        os_version = subprocess.check_output(["uname", "-r"], text=True).strip()
-    elif sys.platform == "win32":
-        win_ver = sys.getwindowsversion()
-        os_version = f"{win_ver.major}.{win_ver.minor}.{win_ver.build}"
-    elif sys.platform == "darwin":
-        output = subprocess.check_output(["sw_vers"], text=True)
-        os_version = output.split("\n")[1].split(":\t")[1]
-        arch = "arm64"   # guessing
-    else:
-        os_version = ""
+    launch_signature, client_launch_id, client_heartbeat_session_id = generate_client_ids()
 
     data = {
         "os": operating_system,
         "browser": "Discord Client",
         "release_channel": "stable",
         "os_version": os_version,
-        "os_arch": arch,
-        "app_arch": arch,
+        "os_arch": os_arch,
+        "app_arch": os_arch,
         "system_locale": system_locale,
         "has_client_mods": False,
         "browser_user_agent": "",
@@ -98,63 +123,50 @@ def get_default_properties():
         "client_build_number": CLIENT_BUILD_NUMBER,
         "native_build_number": None,
         "client_event_source": None,
-        "launch_signature": generate_launch_signature(),
-        "client_launch_id": str(uuid.uuid4()),
-        "client_heartbeat_session_id": str(uuid.uuid4()),
+        "launch_signature": launch_signature,
+        "client_launch_id": client_launch_id,
+        "client_heartbeat_session_id": client_heartbeat_session_id,
     }
-    if sys.platform == "linux":
-        data["window_manager"] = os.environ.get("XDG_CURRENT_DESKTOP", "unknown") + "," + os.environ.get("GDMSESSION", "unknown")
+    if window_manager:
+        data["window_manager"] = window_manager
 
-    user_agent = adjust_user_agent_os(USER_AGENT_DESKTOP, sys.platform, os_version)
+    user_agent = adjust_user_agent_os(USER_AGENT_DESKTOP, os_version)
     data = add_client_version(data, user_agent)
 
     return add_user_agent(data, user_agent)
 
 
-def generate_launch_signature():
-    """Gebnerate launch singature"""
-    bits = 0b00000000100000000001000000010000000010000001000000001000000000000010000010000001000000000100000000000001000000000000100000000000
-    launch_signature = uuid.uuid4().int & (~bits & ((1 << 128) - 1))
-    return str(uuid.UUID(int=launch_signature))
+def generate_launch_signature(random_bytes=None):
+    """Generate launch signature, optionally from provided 16 random bytes"""
+    if random_bytes is None:
+        random_bytes = os.urandom(16)
+    launch_signature = int.from_bytes(random_bytes, "big") & LAUNCH_SIGNATURE_MASK
+    return str(uuid.UUID(int=launch_signature, version=4))
+
+
+def generate_client_ids():
+    """Generate launch signature, client launch id and heartbeat session id from single random read"""
+    random_bytes = os.urandom(48)
+    return (
+        generate_launch_signature(random_bytes[:16]),
+        str(uuid.UUID(bytes=random_bytes[16:32], version=4)),
+        str(uuid.UUID(bytes=random_bytes[32:], version=4)),
+    )
 
 
 def add_for_gateway(data):
     """Add extra data for gateway"""
-    gateway_data = data.copy()
-    gateway_data.update({
+    return {
+        **data,
         "client_app_state": "unfocused",
         "is_fast_connect": False,
-    })
-    return gateway_data
+    }
 
 
 def add_user_agent(data, user_agent):
     """Add browser user agent to client properties and extract browser version"""
-    browser_version = ""
-    if "Firefox" in user_agent:
-        match = re.search(r"Firefox/([\d\.]+)", user_agent)
-        if match:
-            browser_version = match.group(1)
-    if "Opera" in user_agent:
-        match = re.search(r"Opera/([\d\.]+)", user_agent)
-        if match:
-            browser_version = match.group(1)
-    if "Trident" in user_agent:
-        match = re.search(r"Trident\/.*rv:([\d\.]+)", user_agent)
-        if match:
-            browser_version = match.group(1)
-    if "Safari" in user_agent:
-        match = re.search(r"Version/([\d\.]+).*Safari/", user_agent)
-        if match:
-            browser_version = match.group(1)
-    elif "Electron" in user_agent:
-        match = re.search(r"Elelctron/([\d\.]+)", user_agent)
-        if match:
-            browser_version = match.group(1)
-    else:
-        match = re.search(r"Chrome/([\d\.]+)", user_agent)
-        if match:
-            browser_version = match.group(1)
+    found = {match.lastgroup: match.group(match.lastgroup) for match in BROWSER_VERSION_RE.finditer(user_agent)}
+    browser_version = next((found[browser] for browser in BROWSER_PRIORITY if browser in found), "")
 
     data["browser_user_agent"] = user_agent
     data["browser_version"] = browser_version
@@ -163,30 +175,41 @@ def add_user_agent(data, user_agent):
 
 def add_client_version(data, user_agent):
     """Add client version from User-Agent"""
-    if "discord/" in user_agent:
-        match = re.search(r"discord\/([\d\.]+)", user_agent)
-        if match:
-            data["client_version"] = match.group(1)
+    match = CLIENT_VERSION_RE.search(user_agent)
+    if match:
+        data["client_version"] = match.group(1)
     return data
 
 
-def adjust_user_agent_os(user_agent, platform, ver):
-    """Adjust user agent string for specific os"""
-    if platform == "win32":
-        if not ver:
-            ver = WINDOWS_VER
-        ver = ".".join(ver.split(".")[:2])
-        new_os = WINDOWS_UA_STRING.replace("%VER", ver)
-    elif platform == "darwin":
-        if not ver:
-            ver = MACOS_VER
-        ver = ver.replace(".", "_")
-        new_os = MACOS_UA_STRING.replace("%VER", ver)
-    else:
-        new_os = LINUX_UA_STRING
-    return user_agent.replace("%OS", new_os)
+def adjust_user_agent_os_linux(user_agent, _ver):
+    """Adjust user agent string for linux"""
+    return user_agent.replace("%OS", LINUX_UA_STRING)
+
+
+def adjust_user_agent_os_win32(user_agent, ver):
+    """Adjust user agent string for windows"""
+    ver = ".".join(ver.split(".")[:2]) if ver else str(WINDOWS_VER)
+    return user_agent.replace("%OS", WINDOWS_UA_STRING).replace("%VER", ver)
+
+
+def adjust_user_agent_os_darwin(user_agent, ver):
+    """Adjust user agent string for macos"""
+    ver = (ver or str(MACOS_VER)).replace(".", "_")
+    return user_agent.replace("%OS", MACOS_UA_STRING).replace("%VER", ver)
+
+
+if sys.platform == "win32":
+    adjust_user_agent_os = adjust_user_agent_os_win32
+elif sys.platform == "darwin":
+    adjust_user_agent_os = adjust_user_agent_os_darwin
+else:
+    adjust_user_agent_os = adjust_user_agent_os_linux
 
 
 def encode_properties(data):
     """Encode properties dict into base64 string"""
-    return base64.b64encode(json.dumps(data, separators=(",", ":")).encode("utf-8")).decode("utf-8")
+    if json.__name__ == "orjson":   # already compact bytes
+        encoded = json.dumps(data)
+    else:
+        encoded = json.dumps(data, separators=(",", ":")).encode("utf-8")
+    return base64.b64encode(encoded).decode("ascii")
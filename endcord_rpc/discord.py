@@ -1,9 +1,6 @@
 import base64
-import http.client
 import logging
 import os
-import socket
-import ssl
 import time
 import urllib.parse
 
@@ -16,11 +13,17 @@ except ImportError:
         import json
 import json as json_
 
-import socks
+import urllib3
 from endcord_rpc import user_settings_pb2
+from endcord_rpc.json_utils import json_dumps_bytes
 from google.protobuf.json_format import MessageToDict
+from urllib3.contrib.socks import SOCKSProxyManager
 
 DISCORD_HOST = "discord.com"
+DETECTABLE_APPS_BUFFER_SIZE = 1 << 20   # 1MiB
+EXE_OS_NUM = {"linux": 0, "win32": 1, "darwin": 2}
+JSON_SKIP_CHARS = frozenset(" \t\n\r,")   # whitespace and separators between array items
+SETTINGS_PROTO_CLASSES = {1: user_settings_pb2.UserSettings}   # 2 - frecency is unused
 logger = logging.getLogger(__name__)
 
 
@@ -43,15 +46,14 @@ def json_array_objects(stream):
                 continue
             if ch == "]":
                 return
-            if ch.isspace() or ch == ",":   # skip space and comma
+            if ch in JSON_SKIP_CHARS:   # skip space and comma
                 i += 1
                 continue
-            try:   # try to get object
-                obj, consumed = decoder.raw_decode(buf[i:])
+            try:   # try to get object, decoding in place without slicing buffer
+                obj, i = decoder.raw_decode(buf, i)
             except json_.JSONDecodeError:
                 break
             yield obj
-            i += consumed
         buf = buf[i:]   # keep incomplete json only
 
 
@@ -87,30 +89,53 @@ class Discord():
         self.proxy = urllib.parse.urlsplit(proxy)
         self.activity_token = None
         self.protos = [[], []]
+        self.http = self.get_pool_manager()
 
 
-    def get_connection(self, host, port):
-        """Get connection object and handle proxying"""
+    def get_pool_manager(self):
+        """Get pool manager that keeps connections alive between requests, and handle proxying"""
+        # not following redirects and retrying only once, same as plain connection
+        options = {
+            "maxsize": 4,
+            "headers": self.header,
+            "retries": urllib3.Retry(total=1, redirect=False),
+            "timeout": 5,
+        }
         if self.proxy.scheme:
-            if self.proxy.scheme.lower() == "http":
-                connection = http.client.HTTPSConnection(self.proxy.hostname, self.proxy.port)
-                connection.set_tunnel(host, port=port)
-            elif "socks" in self.proxy.scheme.lower():
-                proxy_sock = socks.socksocket()
-                proxy_sock.set_proxy(socks.SOCKS5, self.proxy.hostname, self.proxy.port)
-                proxy_sock.settimeout(10)
-                proxy_sock.connect((host, port))
-                ssl_context = ssl.create_default_context()
-                ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
-                proxy_sock = ssl_context.wrap_socket(proxy_sock, server_hostname=host)
-                # proxy_sock.do_handshake()   # seems like its not needed
-                connection = http.client.HTTPSConnection(host, port, timeout=10)
-                connection.sock = proxy_sock
-            else:
-                connection = http.client.HTTPSConnection(host, port)
-        else:
-            connection = http.client.HTTPSConnection(host, port, timeout=5)
-        return connection
+            scheme = self.proxy.scheme.lower()
+            if scheme == "http":
+                return urllib3.ProxyManager(f"http://{self.proxy.hostname}:{self.proxy.port}", **options)
+            if "socks" in scheme:
+                options["timeout"] = 10
+                return SOCKSProxyManager(f"socks5h://{self.proxy.hostname}:{self.proxy.port}", **options)
+        return urllib3.PoolManager(**options)
+
+
+    def request(self, method, url, data=None, extra_header=None, preload_content=True):
+        """
+        Send request using pooled connections, that are reused between requests.
+        data is encoded as json, response body is decoded if it is valid json.
+        If preload_content is False, response object is returned instead body, so it can be streamed.
+        Return response status and body, status is None if there is no connection.
+        """
+        message_data = None if data is None else json_dumps_bytes(data)
+        header = None if extra_header is None else self.header | extra_header
+        try:
+            response = self.http.request(
+                method,
+                f"https://{self.host}{url}",
+                body=message_data,
+                headers=header,
+                preload_content=preload_content,
+            )
+        except urllib3.exceptions.HTTPError:
+            return None, None
+        if not preload_content:
+            return response.status, response
+        try:
+            return response.status, json.loads(response.data)
+        except ValueError:
+            return response.status, response.data
 
 
     def get_settings_proto(self, num):
@@ -121,116 +146,81 @@ class Discord():
         """
         if self.protos[num-1]:
             return self.protos[num-1]
-        message_data = None
+        proto_class = SETTINGS_PROTO_CLASSES.get(num)
+        if proto_class is None:   # unused, dont even download it
+            return {}
         url = f"/api/v9/users/@me/settings-proto/{num}"
-        try:
-            connection = self.get_connection(self.host, 443)
-            connection.request("GET", url, message_data, self.header)
-            response = connection.getresponse()
-        except (socket.gaierror, TimeoutError):
-            connection.close()
+        status, body = self.request("GET", url)
+        if status is None:
             return None
-        if response.status == 200:
-            data = json.loads(response.read())["settings"]
-            connection.close()
-            if num == 1:
-                decoded = user_settings_pb2.UserSettings.FromString(base64.b64decode(data))
-            elif num == 2:   # unused
-                return {}
-            else:
-                return {}
+        if status == 200:
+            decoded = proto_class.FromString(base64.b64decode(body["settings"]))
             self.protos[num-1] = MessageToDict(decoded)
             return self.protos[num-1]
-        logger.error(f"Failed to fetch settings. Response code: {response.status}")
-        print(f"Failed to fetch settings. Response code: {response.status}")
+        logger.error(f"Failed to fetch settings. Response code: {status}")
+        print(f"Failed to fetch settings. Response code: {status}")
         return False
 
 
     def get_rpc_app(self, app_id):
         """Get data about Discord RPC application"""
-        message_data = None
         url = f"/api/v9/oauth2/applications/{app_id}/rpc"
-        try:
-            connection = self.get_connection(self.host, 443)
-            connection.request("GET", url, message_data, self.header)
-            response = connection.getresponse()
-        except (socket.gaierror, TimeoutError):
-            connection.close()
+        status, body = self.request("GET", url)
+        if status is None:
             return 1, None
-        if response.status == 200:
-            data = json.loads(response.read())
-            connection.close()
+        if status == 200:
             return 0, {
-                "id": data["id"],
-                "name": data["name"],
-                "description": data["description"],
+                "id": body["id"],
+                "name": body["name"],
+                "description": body["description"],
             }
-        if response.status == 404:
+        if status == 404:
             return 2, None
-        logger.error(f"Failed to fetch application rpc data. Response code: {response.status}")
-        print(f"Failed to fetch application rpc data. Response code: {response.status}")
-        connection.close()
+        logger.error(f"Failed to fetch application rpc data. Response code: {status}")
+        print(f"Failed to fetch application rpc data. Response code: {status}")
         return 3, None
 
 
     def get_rpc_app_assets(self, app_id):
         """Get Discord application assets list"""
-        message_data = None
         url = f"/api/v9/oauth2/applications/{app_id}/assets"
-        try:
-            connection = self.get_connection(self.host, 443)
-            connection.request("GET", url, message_data, self.header)
-            response = connection.getresponse()
-        except (socket.gaierror, TimeoutError):
-            connection.close()
+        status, body = self.request("GET", url)
+        if status is None:
             return None
-        if response.status == 200:
-            data = json.loads(response.read())
-            connection.close()
+        if status == 200:
             assets = []
-            for asset in data:
+            for asset in body:
                 assets.append({
                     "id": asset["id"],
                     "name": asset["name"],
                 })
             return assets
-        logger.error(f"Failed to fetch application assets. Response code: {response.status}")
-        print(f"Failed to fetch application assets. Response code: {response.status}")
-        connection.close()
+        logger.error(f"Failed to fetch application assets. Response code: {status}")
+        print(f"Failed to fetch application assets. Response code: {status}")
         return False
 
 
-    def get_rpc_app_external(self, app_id, asset_url):
-        """Get Discord application external assets"""
-        message_data = json.dumps({"urls": [asset_url]})
+    def get_rpc_app_external(self, app_id, asset_urls):
+        """Get Discord application external assets, in same order as asset_urls"""
         url = f"/api/v9/applications/{app_id}/external-assets"
-        try:
-            connection = self.get_connection(self.host, 443)
-            connection.request("POST", url, message_data, self.header)
-            response = connection.getresponse()
-        except (socket.gaierror, TimeoutError):
-            connection.close()
+        status, body = self.request("POST", url, {"urls": asset_urls})
+        if status is None:
             return None
-        if response.status == 200:
-            data = json.loads(response.read())
-            connection.close()
-            return data
-        if response.status == 429:
-            data = json.loads(response.read())
-            connection.close()
-            retry_after = float(data["retry_after"])
+        if status == 200:
+            return body
+        if status == 429:
+            retry_after = float(body["retry_after"])
             logger.error("Failed to fetch application external assets. Response code: 429 - Retry after: {retry_after}")
             print(f"Failed to fetch application external assets. Response code: 429 - Retry after: {retry_after}")
             return retry_after
-        logger.error(f"Failed to fetch application external assets. Response code: {response.status}")
-        print(f"Failed to fetch application external assets. Response code: {response.status}")
-        connection.close()
+        logger.error(f"Failed to fetch application external assets. Response code: {status}")
+        print(f"Failed to fetch application external assets. Response code: {status}")
         return False
 
 
     def update_activity_session(self, app_id, exe_path, closed, session_id, media_session_id=None, voice_channel_id=None):
         """Send update for currently running activity session"""
-        message_data = json.dumps({
+        message_data = {
             "token": self.activity_token,
             "application_id": app_id,
             "share_activity": True,
@@ -239,22 +229,16 @@ class Discord():
             "session_id": session_id,
             "media_session_id": media_session_id,
             "closed": closed,
-        })
+        }
         url = "/api/v9/activities"
-        try:
-            connection = self.get_connection(self.host, 443)
-            connection.request("POST", url, message_data, self.header)
-            response = connection.getresponse()
-        except (socket.gaierror, TimeoutError):
-            connection.close()
+        status, body = self.request("POST", url, message_data)
+        if status is None:
             return None
-        if response.status == 200:
-            self.activity_token = json.loads(response.read())["token"]
-            connection.close()
+        if status == 200:
+            self.activity_token = body["token"]
             return self.activity_token
-        logger.error(f"Failed to update activity session. Response code: {response.status}")
-        print(f"Failed to update activity session. Response code: {response.status}")
-        connection.close()
+        logger.error(f"Failed to update activity session. Response code: {status}")
+        print(f"Failed to update activity session. Response code: {status}")
         return False
 
 
@@ -264,35 +248,32 @@ class Discord():
         Use etag to skip downloading same cached resource.
         File is saved as: detectable_apps_{etag}_{current_time}.ndjson, where current_time is unix_time/1000
         """
-        message_data = None
         url = "/api/v9/applications/detectable"
-        if etag:
-            header = self.header | {"If-None-Match": f'W/"{etag}"'}
-        else:
-            header = self.header
-        try:
-            connection = self.get_connection(self.host, 443)
-            connection.request("GET", url, message_data, header)
-            response = connection.getresponse()
-        except (socket.gaierror, TimeoutError):
-            connection.close()
+        extra_header = {"If-None-Match": f'W/"{etag}"'} if etag else None
+        status, response = self.request("GET", url, extra_header=extra_header, preload_content=False)
+        if status is None:
             return None, etag
-        if response.status == 200:
-            current_time = int(time.time()/1000)
-            etag = response.getheader("ETag")[3:-1]
+        current_time = int(time.time()/1000)
+        if status == 200:
+            etag = response.headers["ETag"][3:-1]
             save_path = os.path.expanduser(os.path.join(save_dir, f"detectable_apps_{etag}_{current_time}.ndjson"))
             using_orjson = json.__name__ == "orjson"
             if using_orjson:
                 nl = b"\n"
             else:
                 nl = "\n"
-            with open(save_path, "w" + ("b" if using_orjson else "")) as f:
+            # large buffer so thousands of small records are written in few big chunks
+            with open(save_path, "w" + ("b" if using_orjson else ""), buffering=DETECTABLE_APPS_BUFFER_SIZE) as f:
                 try:
-                    for app in json_array_objects(response):
+                    if using_orjson:   # orjson is fast enough to parse entire list at once
+                        apps = json.loads(response.read())
+                    else:
+                        apps = json_array_objects(response)
+                    exe_os_num = EXE_OS_NUM.get
+                    for app in apps:
                         executables = []
                         for exe in app["executables"]:
-                            exe_os = exe["os"]
-                            exe_os = 0 if exe_os == "linux" else 1 if exe_os == "win32" else 2 if exe_os == "darwin" else None
+                            exe_os = exe_os_num(exe["os"])
                             if exe_os is not None:
                                 path_piece = exe["name"].lower()
                                 if not path_piece.startswith("/"):
@@ -306,9 +287,13 @@ class Discord():
                     logger.error(f"Error decoding detectable apps json: {e}")
                     print(f"Error decoding detectable apps json: {e}")
                     return None, etag
+                finally:
+                    response.drain_conn()
+                    response.release_conn()
                 return save_path, etag
-        elif response.status == 304:   # not modified
+        response.drain_conn()
+        response.release_conn()
+        if status == 304:   # not modified
             save_path = os.path.expanduser(os.path.join(save_dir, f"detectable_apps_{etag}_{current_time}.ndjson"))
             return save_path, etag
-        connection.close()
         return None, etag
@@ -1,5 +1,6 @@
 import glob
 import logging
+import mmap
 import os
 import sys
 import threading
@@ -20,9 +21,14 @@ if sys.platform != "linux":
 
 GAME_DETECTION_DELAY = 5
 MAX_CACHE_AGE = 604800   # 7 days
+CACHE_SAVE_DELAY = 60
+CMDLINE_READ_SIZE = 4096
+SKIP_CMDLINE_PREFIXES = (b"/usr/lib", b"bash")
+PATH_TRANSLATION = str.maketrans({"\\": "/", "\x00": None, ":": None})
+PLATFORM_MATCHES = ((0, 1), (1, ), (2, ))   # linux matches linux(0) and windows(1), windows(1), macos(2)
 logger = logging.getLogger(__name__)
 
-proc_cache = {}   # pid = [path, alive]
+proc_cache = {}   # pid = path, path is None for skipped processes
 
 
 def load_json(file, dir_path, default=None):
@@ -31,8 +37,8 @@ def load_json(file, dir_path, default=None):
     if not os.path.exists(path):
         return default
     try:
-        with open(path, "r") as f:
-            data = json_.load(f)
+        with open(path, "rb") as f:
+            data = json.loads(f.read())
             if default:
                 for key, value in default.items():
                     _ = data.setdefault(key, value)
@@ -42,12 +48,20 @@ def load_json(file, dir_path, default=None):
 
 
 def save_json(data, file, dir_path):
-    """Save json to same location where default config is saved"""
+    """Save json to same location where default config is saved, file is replaced atomically"""
+    dir_path = os.path.expanduser(dir_path)
     if not os.path.exists(dir_path):
-        os.makedirs(os.path.expanduser(dir_path), exist_ok=True)
-    path = os.path.expanduser(os.path.join(dir_path, file))
-    with open(path, "w") as f:
-        json_.dump(data, f, indent=2)
+        os.makedirs(dir_path, exist_ok=True)
+    path = os.path.join(dir_path, file)
+    if json.__name__ == "orjson":
+        encoded = json.dumps(data, option=json.OPT_INDENT_2)
+    else:
+        encoded = json_.dumps(data, indent=2).encode("utf-8")
+    # write to temporary file first so crash while writing wont corrupt existing file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(encoded)
+    os.replace(tmp_path, path)
 
 
 def get_user_processes_diff_linux():
@@ -56,70 +70,75 @@ def get_user_processes_diff_linux():
     Not using psutil because this is much more efficient.
     """
     added = []
+    added_set = set()
     removed = []
+    removed_set = set()
+    seen = set()
+    seen_add = seen.add
+
+    with os.scandir("/proc") as entries:
+        for entry in entries:
+            pid = entry.name
+            if not pid[0].isdigit():   # only pid dirs start with digit
+                continue
 
-    for pid in os.listdir("/proc"):
-        if not pid.isdigit():
-            continue
-
-        # check cache
-        if pid in proc_cache:
-           proc_cache[pid][1] = True
-           continue
-        proc_cache[pid] = [None, True]
+            # check cache, skipped processes are cached too, with None path
+            seen_add(pid)
+            if pid in proc_cache:
+                continue
+            proc_cache[pid] = None
 
-        # read and check uid
-        try:
-            with open(f"/proc/{pid}/status", "r") as f:
-                uid = None
-                for line in f:
-                    if line.startswith("Uid:"):
-                        uid = int(line.split()[1])
-                        break
-        except Exception:
-            continue
-        if uid is None or uid < 1000:
-            continue
+            # check uid, /proc/pid is owned by process user
+            try:
+                uid = entry.stat(follow_symlinks=False).st_uid
+            except OSError:
+                continue
+            if uid < 1000:
+                continue
 
-        # read cmdline
-        try:
-            with open(f"/proc/{pid}/cmdline", "rb") as f:
-                # decode only what is needed, not entire file
-                cmdline = f.read().partition(b" -")[0].partition(b"\x00-")[0]
-                prefix, exe, _ = cmdline.partition(b".exe")
-                cmdline = prefix + exe
-                if not cmdline:
-                    continue
-                cmdline = cmdline.decode("utf-8")
-        except Exception:
-            continue
+            # read cmdline, executable path is at the start so one read is enough
+            try:
+                fd = os.open(f"/proc/{pid}/cmdline", os.O_RDONLY)
+                try:
+                    cmdline = os.read(fd, CMDLINE_READ_SIZE)
+                finally:
+                    os.close(fd)
+            except OSError:
+                continue
 
-        # skip libraries and bash
-        if cmdline.startswith("/usr/lib") or cmdline.startswith("bash"):
-            continue
+            # decode only what is needed, not entire file
+            cmdline = cmdline.partition(b" -")[0].partition(b"\x00-")[0]
+            prefix, exe, _ = cmdline.partition(b".exe")
+            cmdline = prefix + exe
+            if not cmdline:
+                continue
 
-        # if path doesnt have / or \ its definitely not a game
-        path = cmdline.replace("\\", "/").replace("\x00", "")
-        if "/" not in path:
-            continue
+            # skip libraries and bash, before decoding
+            if cmdline.startswith(SKIP_CMDLINE_PREFIXES):
+                continue
+            try:
+                cmdline = cmdline.decode("utf-8")
+            except UnicodeDecodeError:
+                continue
 
-        # cleanup path
-        path = path.lower().replace(":", "")
+            # cleanup path, if it doesnt have / or \ its definitely not a game
+            path = cmdline.translate(PATH_TRANSLATION)
+            if "/" not in path:
+                continue
+            path = path.lower()
 
-        # add to cache and newly added processes
-        proc_cache[pid] = [path, True]
-        if path not in added:
-            added.append(path)
+            # add to cache and newly added processes
+            proc_cache[pid] = path
+            if path not in added_set:
+                added_set.add(path)
+                added.append(path)
 
-    # remove all not alive processes, and flip alive status
-    for key in list(proc_cache.keys()):
-        if not proc_cache[key][1]:
-            path = proc_cache[key][0]
-            if path and path not in removed:
-                removed.append((path))
-            del proc_cache[key]
-        else:
-            proc_cache[key][1] = False
+    # remove all processes not seen in this tick
+    for pid in proc_cache.keys() - seen:
+        path = proc_cache.pop(pid)
+        if path and path not in removed_set:
+            removed_set.add(path)
+            removed.append(path)
 
     return added, removed
 
@@ -127,30 +146,39 @@ def get_user_processes_diff_linux():
 def get_user_processes_diff_windows():
     """Get newly added and removed user processes on windows, deduplicated and cached"""
     added = []
+    added_set = set()
     removed = []
+    removed_set = set()
+    seen = set()
+    seen_add = seen.add
 
-    # not doing process_iter([...]) because there is caching
+    # not doing process_iter([...]) because it would query attributes of cached processes too
     current_username = psutil.Process().username().split("\\")[-1]
     for p in psutil.process_iter():
         pid = p.pid
 
-        # check cache
+        # check cache, skipped processes are cached too, with None path
+        seen_add(pid)
         if pid in proc_cache:
-           proc_cache[pid][1] = True
-           continue
-        proc_cache[pid] = [None, True]
-
-        # skip system processes
-        username = p.username()
-        if username is None:
             continue
+        proc_cache[pid] = None
 
-        # keep only current user
-        if username.split("\\")[-1] != current_username:
-            continue
+        # query only new processes, in one snapshot, access denied means its not user process
+        try:
+            with p.oneshot():
+                # skip system processes
+                username = p.username()
+                if username is None:
+                    continue
 
-        # get cmdline
-        cmdline = p.cmdline()
+                # keep only current user
+                if username.split("\\")[-1] != current_username:
+                    continue
+
+                # get cmdline
+                cmdline = p.cmdline()
+        except psutil.Error:
+            continue
         if not cmdline:
             continue
         cmdline = cmdline[0]
@@ -159,28 +187,24 @@ def get_user_processes_diff_windows():
         if ":\\Windows\\" in cmdline or ":\\Program Files\\WindowsApps\\" in cmdline:
             continue
 
-        # if path doesnt have / or \ its definitely not a game
-        path = cmdline.replace("\\", "/").replace("\x00", "")
+        # cleanup path, if it doesnt have / or \ its definitely not a game
+        path = cmdline.translate(PATH_TRANSLATION)
         if "/" not in path:
             continue
-
-        # cleanup path
-        path = path.lower().replace(":", "")
+        path = path.lower()
 
         # add to cache and newly added processes
-        proc_cache[pid] = [path, True]
-        if path not in added:
+        proc_cache[pid] = path
+        if path not in added_set:
+            added_set.add(path)
             added.append(path)
 
-    # remove all not alive processes, and flip alive status
-    for key in list(proc_cache.keys()):
-        if not proc_cache[key][1]:
-            path = proc_cache[key][0]
-            if path and path not in removed:
-                removed.append((path))
-            del proc_cache[key]
-        else:
-            proc_cache[key][1] = False
+    # remove all processes not seen in this tick
+    for pid in proc_cache.keys() - seen:
+        path = proc_cache.pop(pid)
+        if path and path not in removed_set:
+            removed_set.add(path)
+            removed.append(path)
 
     return added, removed
 
@@ -191,16 +215,20 @@ def get_user_processes_diff_darwin():
     Probably wont work but here it is anyways.
     """
     added = []
+    added_set = set()
     removed = []
+    removed_set = set()
+    seen = set()
+    seen_add = seen.add
     user_uid = psutil.Process().uids().real
     for p in psutil.process_iter():
         pid = p.pid
 
-        # check cache
+        # check cache, skipped processes are cached too, with None path
+        seen_add(pid)
         if pid in proc_cache:
-           proc_cache[pid][1] = True
-           continue
-        proc_cache[pid] = [None, True]
+            continue
+        proc_cache[pid] = None
 
         # check uid
         if user_uid:
@@ -221,23 +249,20 @@ def get_user_processes_diff_darwin():
         cmdline = cmdline[0]
 
         # cleanup path
-        path = cmdline.replace("\\", "/").replace("\x00", "")
-        path = path.lower().replace(":", "")
+        path = cmdline.translate(PATH_TRANSLATION).lower()
 
         # add to cache and newly added processes
-        proc_cache[pid] = [path, True]
-        if path not in added:
+        proc_cache[pid] = path
+        if path not in added_set:
+            added_set.add(path)
             added.append(path)
 
-    # remove all not alive processes, and flip alive status
-    for key in list(proc_cache.keys()):
-        if not proc_cache[key][1]:
-            path = proc_cache[key][0]
-            if path and path not in removed:
-                removed.append((path))
-            del proc_cache[key]
-        else:
-            proc_cache[key][1] = False
+    # remove all processes not seen in this tick
+    for pid in proc_cache.keys() - seen:
+        path = proc_cache.pop(pid)
+        if path and path not in removed_set:
+            removed_set.add(path)
+            removed.append(path)
 
     return added, removed
 
@@ -263,52 +288,99 @@ def find_detectable_apps_file(directory):
     return path, etag, save_time
 
 
-def find_app(proc_path, list_path, my_platform):
-    """Search the detectable applications list and find the app"""
+def map_detectable_apps(list_path):
+    """Memory-map detectable applications list so it can be searched without reading it each time"""
+    try:
+        with open(list_path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):   # ValueError is for empty file
+        return None
+
+
+def index_detectable_apps(apps_map, my_platform):
+    """
+    Build index of app paths for this platform from memory-mapped detectable applications list.
+    Each app path points to offset of first line containing it, so only matched line is parsed again.
+    Also returns length of longest app path, so find_app doesnt check longer substrings.
+    """
+    platforms = PLATFORM_MATCHES[my_platform]
+    apps_index = {}
+    add = apps_index.setdefault
+    loads = json.loads   # bytes are parsed directly, without decoding
+    find = apps_map.find
+    size = len(apps_map)
+    start = 0
+    while start < size:
+        end = find(b"\n", start)
+        if end == -1:
+            end = size
+        try:
+            app = loads(apps_map[start:end])   # [id, name, [os, app_path]]
+        except Exception:
+            start = end + 1
+            continue
+        for platform_val, app_path in app[2]:
+            if app_path and platform_val in platforms:
+                add(app_path, start)
+        start = end + 1
+    return apps_index, max(map(len, apps_index), default=0)
+
+
+def find_app(proc_path, apps_map, apps_index, max_path_len, my_platform):
+    """Search the detectable applications index and find the app"""
     proc_path = proc_path.lower()
 
-    try:
-        f = open(list_path, "r", encoding="utf-8")
-    except Exception:
+    # app matches if its path is substring of proc_path, and all app paths start with /
+    # so look up every substring starting at /, and take app that is first in the list
+    get = apps_index.get
+    first = None
+    length = len(proc_path)
+    start = proc_path.find("/")
+    while start != -1:
+        for end in range(start + 1, min(start + max_path_len, length) + 1):
+            offset = get(proc_path[start:end])
+            if offset is not None and (first is None or offset < first):
+                first = offset
+        start = proc_path.find("/", start + 1)
+    if first is None:
         return None, None, None
-    try:
-        for line in f:
-            try:
-                app = json.loads(line)   # [id, name, [os, app_path]]
-            except Exception:
-                continue
-            for platform_val, app_path in app[2]:
-                if not app_path:
-                    continue
-                if my_platform == 0:   # linux matches linux(0) and windows(1)
-                    if platform_val not in (0, 1):
-                        continue
-                elif my_platform == 1:   # windows
-                    if platform_val != 1:
-                        continue
-                elif platform_val != 2:   # macos
-                    continue
-                if app_path in proc_path:
-                    return app[0], app[1], app_path[1:]
-    finally:
-        f.close()
+
+    # find which executable matched
+    platforms = PLATFORM_MATCHES[my_platform]
+    end = apps_map.find(b"\n", first)
+    if end == -1:   # last line
+        end = len(apps_map)
+    app = json.loads(apps_map[first:end])
+    for platform_val, app_path in app[2]:
+        if app_path and platform_val in platforms and app_path in proc_path:
+            return app[0], app[1], app_path[1:]
     return None, None, None
 
 
 class GameDetection:
     """Main game detection class"""
 
-    def __init__(self, gateway, discord, blacklist, config_path, download_delay=7):
+    def __init__(self, gateway, discord, blacklist, config_path, download_delay=7, update_event=None):
         self.gateway = gateway
         self.discord = discord
         self.run = True
         self.changed = False
+        self.update_event = update_event or threading.Event()   # set when activities change
         self.cache = []
-        self.activities = []
-        self.blacklist = blacklist
+        self.activities = {}   # {app_id: activity}
+        self.blacklist = set(blacklist)
         self.config_path = config_path
         self.download_delay = download_delay * 86400
-        threading.Thread(target=self.main, daemon=True, args=()).start()
+        self.stop_event = threading.Event()   # set to wake and stop main thread
+        self.thread = threading.Thread(target=self.main, daemon=True, args=())
+        self.thread.start()
+
+
+    def stop(self):
+        """Stop main thread and wait for it to save pending cache changes"""
+        self.run = False
+        self.stop_event.set()
+        self.thread.join(timeout=GAME_DETECTION_DELAY + 1)
 
 
     def main(self):
@@ -345,9 +417,17 @@ class GameDetection:
                 print(f'Downloaded new detectable applications list with ETag: W/"{etag}"')
                 if old_path:
                     os.remove(old_path)
+            elif old_path and old_path != path:   # not modified, only refresh save time
+                os.replace(old_path, path)
             del (old_path, old_etag)
         else:
             path = old_path
+        apps_map = map_detectable_apps(path)
+        if apps_map is None:
+            logger.info("Could not start game detection service: failed to read detectable applications list")
+            print("Could not start game detection service: failed to read detectable applications list")
+            return
+        apps_index, max_path_len = index_detectable_apps(apps_map, platform)
 
         # load cached processes and remove outdated
         self.cache = load_json("detected_apps_cache.json", self.config_path, {})   # {proc_path: [app_id, app_name, app_path, last_seen]...}
@@ -376,6 +456,8 @@ class GameDetection:
         logger.info("Game detection service started")
         print("Game detection service started")
         cache_changed = True   # to save updated times
+        removed_apps = {}
+        last_save = 0
         _get_user_processes_diff = get_user_processes_diff
         while self.run:
             try:
@@ -386,84 +468,112 @@ class GameDetection:
                 self.run = False
                 return
 
+            now_ms = int(time.time() * 1000)
+            now_s = now_ms // 1000
+
+            # blacklist and session id can change between ticks
+            cache = self.cache
+            blacklist = self.blacklist
+            activities = self.activities
+            update_activity_session = self.discord.update_activity_session
+            session_id = self.gateway.session_id
+            session_updates = {}   # {app_id: (app_path, closed)}
+            prev_removed_apps = removed_apps
+            removed_apps = {}   # {app_id: (app_path, start)}
+
+            # removals first, so restarted app in the same tick keeps its activity
+            # when identified app disappears
+            for proc_path in removed:
+                # find app_name and app_path
+                data = cache.get(proc_path)
+                if not data:
+                    continue
+                app_id, app_name, app_path, _ = data
+                if not app_id:
+                    continue
+                if app_id in blacklist:
+                    continue
+
+                # queue activity session update
+                session_updates[app_id] = (app_path, True)
+                # remove activity, remember start time in case it reappears
+                activity = activities.pop(app_id, None)
+                if activity:
+                    removed_apps[app_id] = (app_path, activity["timestamps"]["start"])
+                self.changed = True
+                self.update_event.set()
+                logger.info(f"Game removed from activities: {app_name}")
+                print(f"Game removed from activities: {app_name}")
+
             for proc_path in added:
-                proc = self.cache.get(proc_path)
+                proc = cache.get(proc_path)
                 if proc:
                     app_id, app_name, app_path = proc[0], proc[1], proc[2]
                 else:
-                    app_id, app_name, app_path = find_app(proc_path, path, platform)
-                    self.cache[proc_path] = [app_id, app_name, app_path, int(time.time())]
+                    app_id, app_name, app_path = find_app(proc_path, apps_map, apps_index, max_path_len, platform)
+                    cache[proc_path] = [app_id, app_name, app_path, now_s]
                     cache_changed = True
 
                 # skip unindentified
                 if not app_id:
                     continue
-                if app_id in self.blacklist:
+                if app_id in blacklist:
                     continue
 
                 # when identified app appears
-                # update activity session
-                self.discord.update_activity_session(
-                    app_id,
-                    exe_path=app_path,
-                    closed=False,
-                    session_id=self.gateway.session_id,
-                    media_session_id=None,
-                    voice_channel_id=None,
-                )
+                # queue activity session update
+                session_updates[app_id] = (app_path, False)
+                # keep start time if app is already running or has just disappeared
+                start = now_ms
+                activity = activities.get(app_id)
+                if activity:
+                    start = activity["timestamps"]["start"]
+                else:
+                    removed_app = removed_apps.get(app_id) or prev_removed_apps.get(app_id)
+                    if removed_app and removed_app[0] == app_path:
+                        start = removed_app[1]
                 # add activity
-                self.activities.append({
+                activities[app_id] = {
                     "type": 0,
                     "application_id": app_id,
                     "name": app_name,
-                    "timestamps": {"start": int(time.time()*1000)},
-                })
+                    "timestamps": {"start": start},
+                }
                 self.changed = True
+                self.update_event.set()
                 logger.info(f"Game added to activities: {app_name}, APP_ID: {app_id}")
                 print(f"Game added to activities: {app_name}, APP_ID: {app_id}")
 
-            # when identified app disappears
-            for proc_path in removed:
-                # find app_name and app_path
-                data = self.cache.get(proc_path)
-                if not data:
-                    continue
-                app_id, app_name, app_path, _ = data
-                if not app_id:
-                    continue
-                if app_id in self.blacklist:
-                    continue
-
-                # update activity session
-                self.discord.update_activity_session(
+            # send one update per app with its final state
+            # sequentially, because each response carries token for the next request
+            for app_id, (app_path, closed) in session_updates.items():
+                update_activity_session(
                     app_id,
                     exe_path=app_path,
-                    closed=True,
-                    session_id=self.gateway.session_id,
+                    closed=closed,
+                    session_id=session_id,
                     media_session_id=None,
                     voice_channel_id=None,
                 )
-                # remove activity
-                for num, activity in enumerate(self.activities):
-                    if activity["application_id"] == app_id:
-                        del self.activities[num]
-                        break
-                self.changed = True
-                logger.info(f"Game removed from activities: {app_name}")
-                print(f"Game removed from activities: {app_name}")
 
-            if cache_changed:
+            # debounce cache writes
+            if cache_changed and now_s - last_save > CACHE_SAVE_DELAY:
                 cache_changed = False
+                last_save = now_s
                 save_json(self.cache, "detected_apps_cache.json", self.config_path)
 
-            time.sleep(GAME_DETECTION_DELAY)
+            self.stop_event.wait(GAME_DETECTION_DELAY)
+
+        # flush pending cache changes
+        if cache_changed:
+            save_json(self.cache, "detected_apps_cache.json", self.config_path)
 
 
     def get_activities(self):
         """Get activities for all detected games, and if they changed"""
         cache = self.changed
         self.changed = False
-        return self.activities, cache
+        return list(self.activities.values()), cache
 
 
     def get_detected(self):
@@ -477,22 +587,17 @@ class GameDetection:
 
     def set_blacklist(self, blacklist):
         """Set blacklisted games"""
-        self.blacklist = blacklist
+        self.blacklist = set(blacklist)
         global proc_cache
         proc_cache = {}
 
-        for app_id in blacklist:
-            if not app_id:
-                return
-            # find app_name and app_path
-            for app in self.cache.values():
-                if app[0] == app_id:
-                    app_name = app[1]
-                    app_path = app[2]
-                    break
-            else:
-                continue
+        # find app_name and app_path of all blacklisted apps in one pass over cache
+        blacklisted = {}
+        for app in self.cache.values():
+            if app[0] and app[0] in self.blacklist:
+                blacklisted.setdefault(app[0], (app[1], app[2]))
 
+        for app_id, (app_name, app_path) in blacklisted.items():
             # update activity session
             self.discord.update_activity_session(
                 app_id,
@@ -503,10 +608,8 @@ class GameDetection:
                 voice_channel_id=None,
             )
             # remove activity
-            for num, activity in enumerate(self.activities):
-                if activity["application_id"] == app_id:
-                    del self.activities[num]
-                    break
+            self.activities.pop(app_id, None)
             self.changed = True
+            self.update_event.set()
             logger.info(f"Game removed from activities: {app_name}")
             print(f"Game removed from activities: {app_name}")
@@ -1,7 +1,8 @@
-import base64
-import gc
+import binascii
 import http.client
 import logging
+import os
+import queue
 import random
 import socket
 import ssl
@@ -24,9 +25,11 @@ except ImportError:
 import socks
 import websocket
 from endcord_rpc import user_settings_pb2
+from endcord_rpc.json_utils import json_dumps_bytes
 from google.protobuf.json_format import MessageToDict
 
 DISCORD_HOST = "discord.com"
+GATEWAY_URL_CACHE_AGE = 86400   # 1 day
 LOCAL_MEMBER_COUNT = 50   # members per guild, CPU-RAM intensive
 ZLIB_SUFFIX = b"\x00\x00\xff\xff"
 VOICE_FLAGS = 3   # CLIPS_ENABLED and ALLOW_VOICE_RECORDING
@@ -34,41 +37,35 @@ DEFAULT_CAPABILITIES = 30717
 DEFAULT_INTENTS = 50364033
 QOS_HEARTBEAT = True
 QOS_PAYLOAD = {"ver": 26, "active": True, "reason": "foregrounded"}
-inflator = zlib.decompressobj()
+EMPTY_DICT = {}   # read only
+TCP_CORK = getattr(socket, "TCP_CORK", getattr(socket, "TCP_NOPUSH", None))   # linux, bsd/macos
 logger = logging.getLogger(__name__)
 status_unpacker = struct.Struct("!H")
 
-
-def zlib_decompress(data):
-    """Decompress zlib data, if it is not zlib compressed, return data instead"""
-    if len(data) < 4 or data[-4:] != ZLIB_SUFFIX:
-        return data
-    try:
-        return inflator.decompress(data)
-    except zlib.error as e:
-        logger.error(f"zlib error: {e}")
-        print(f"zlib error: {e}")
-        return None
+# qos heartbeat is constant except sequence, so its serialized once
+HEARTBEAT_PREFIX, HEARTBEAT_SUFFIX = json_dumps_bytes({"op": 1, "d": {"seq": "SEQ", "qos": QOS_PAYLOAD}}).split(b'"SEQ"')
 
 
-def reset_inflator():
-    """Resets inflator object"""
-    global inflator
-    del inflator
-    inflator = zlib.decompressobj()   # noqa
+def decode_settings_proto(encoded):
+    """
+    Decode base64 encoded user settings proto.
+    Only status settings are used, so only they are converted to dict, instead of entire message.
+    """
+    decoded = user_settings_pb2.UserSettings.FromString(binascii.a2b_base64(encoded))
+    if decoded.HasField("status"):
+        return {"status": MessageToDict(decoded.status)}
+    return {}
 
 
 def double_get(data, key1, key2, default=None):
     """Get value from 2 nested dicts"""
-    if key1 in data:
-        return data[key1].get(key2, default)
-    return default
+    return data.get(key1, EMPTY_DICT).get(key2, default)
 
 
 class Gateway():
     """Methods for fetching and sending data to Discord gateway through websocket"""
 
-    def __init__(self, token, host, client_prop, user_agent, proxy=None, capablities=None):
+    def __init__(self, token, host, client_prop, user_agent, proxy=None, capablities=None, cache_path=None, update_event=None):
         if host:
             host_obj = urllib.parse.urlsplit(host)
             if host_obj.netloc:
@@ -94,6 +91,8 @@ class Gateway():
         self.init_time = time.time() * 1000
         self.token = token
         self.proxy = urllib.parse.urlsplit(proxy)
+        self.cache_path = cache_path
+        self.update_event = update_event or threading.Event()   # set when there is new data for main loop
         self.run = True
         self.wait = False
         self.state = 0
@@ -102,8 +101,11 @@ class Gateway():
         self.resume_gateway_url = ""
         self.session_id = ""
         self.ready = False
+        self.ready_event = threading.Event()
+        self.online_event = threading.Event()
+        self.heartbeat_stop = threading.Event()
         self.my_status = {}
-        self.reconnect_requested = False
+        self.reconnect_event = threading.Event()
         self.status_changed = False
         self.user_settings_proto = None
         self.proto_changed = False
@@ -111,18 +113,69 @@ class Gateway():
         self.token_update = None
         self.error = None
         self.resumable = False
+        self.reset_inflator()
+        self.opcode_handlers = {
+            0: self.handle_dispatch,
+            1: self.handle_heartbeat_request,
+            7: self.handle_reconnect,
+            9: self.handle_invalid_session,
+            10: self.handle_hello,
+            11: self.handle_heartbeat_ack,
+        }
+        self.event_handlers = {
+            "READY": self.handle_ready,
+            "SESSIONS_REPLACE": self.handle_sessions_replace,
+            "USER_SETTINGS_PROTO_UPDATE": self.handle_user_settings_proto_update,
+            "USER_UPDATE": self.set_my_user_data,
+        }
         threading.Thread(target=self.thread_guard, daemon=True, args=()).start()
 
 
     def thread_guard(self):
-        """Check if reconnect is requested and run reconnect thread if its not running"""
+        """Wait until reconnect is requested and run reconnect, one at a time"""
         while self.run:
-            if self.reconnect_requested:
-                self.reconnect_requested = False
-                if not self.reconnect_thread.is_alive():
-                    self.reconnect_thread = threading.Thread(target=self.reconnect, daemon=True, args=())
-                    self.reconnect_thread.start()
-            time.sleep(0.5)
+            self.reconnect_event.wait()
+            if self.run:
+                try:
+                    self.reconnect()
+                except Exception as e:   # keep guard alive so later request can retry
+                    logger.error(f"Reconnect failed:\n{"".join(traceback.format_exception(e))}")
+                    print(f"Reconnect failed: {e}")
+            # requests made while reconnecting (eg. by stopping receiver) are handled by it
+            self.reconnect_event.clear()
+
+
+    def reset_inflator(self):
+        """Start new zlib stream, must be called for each new websocket connection"""
+        self.inflator = zlib.decompressobj()
+        self.zlib_buffer = bytearray()
+        self.zlib_stream = False
+
+
+    def zlib_decompress(self, data):
+        """
+        Decompress zlib data, if it is not zlib compressed, return data instead.
+        Message can be split into multiple frames, only the last one ends with ZLIB_SUFFIX,
+        so partial frames are buffered and None is returned until message is complete.
+        """
+        if isinstance(data, str):   # text frame, never compressed
+            return data
+        if not data.endswith(ZLIB_SUFFIX):
+            if not self.zlib_stream and not self.zlib_buffer:
+                return data
+            self.zlib_buffer += data
+            return None
+        self.zlib_stream = True
+        if self.zlib_buffer:
+            self.zlib_buffer += data
+            data = self.zlib_buffer
+            self.zlib_buffer = bytearray()
+        try:
+            return self.inflator.decompress(data)
+        except zlib.error as e:
+            logger.error(f"zlib error: {e}")
+            print(f"zlib error: {e}")
+            return None
 
 
     def connect_ws(self, resume=False):
@@ -142,6 +195,12 @@ class Gateway():
             )
         else:
             self.ws.connect(gateway_url + "/?v=9&encoding=json&compress=zlib-stream", header=self.header)
+        # disable nagle so small frames like heartbeats are not delayed
+        # websocket-client already does this for direct connections, but not for proxied sockets
+        try:
+            self.ws.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
 
 
     def disconnect_ws(self, timeout=2, status=1000):
@@ -159,8 +218,8 @@ class Gateway():
                 self.ws = None
 
 
-    def connect(self):
-        """Create initial connection to Discord gateway"""
+    def get_gateway_url(self):
+        """Fetch gateway url from discord api"""
         # get proxy
         if self.proxy.scheme:
             if self.proxy.scheme.lower() == "http":
@@ -195,20 +254,61 @@ class Gateway():
         if response.status == 200:
             data = response.read()
             connection.close()
-            self.gateway_url = json.loads(data)["url"]
-        else:
-            connection.close()
-            logger.error(f"Failed to get gateway url. Response code: {response.status}. Exiting...")
-            raise SystemExit(f"Failed to get gateway url. Response code: {response.status}. Exiting...")
+            return json.loads(data)["url"]
+        connection.close()
+        logger.error(f"Failed to get gateway url. Response code: {response.status}. Exiting...")
+        raise SystemExit(f"Failed to get gateway url. Response code: {response.status}. Exiting...")
+
+
+    def load_gateway_url(self):
+        """Load cached gateway url, if it is for the same host and not older than GATEWAY_URL_CACHE_AGE"""
+        if not self.cache_path:
+            return None
+        path = os.path.join(self.cache_path, "gateway_url.txt")
+        try:
+            if time.time() - os.path.getmtime(path) > GATEWAY_URL_CACHE_AGE:
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                host, _, url = f.read().strip().partition("\n")
+        except OSError:
+            return None
+        if host != self.host:   # custom host changed
+            return None
+        return url.strip() or None
+
+
+    def save_gateway_url(self, url):
+        """Cache gateway url together with its host so it is not fetched on each start"""
+        if not self.cache_path:
+            return
+        try:
+            with open(os.path.join(self.cache_path, "gateway_url.txt"), "w", encoding="utf-8") as f:
+                f.write(f"{self.host}\n{url}")
+        except OSError:
+            pass
 
-        self.connect_ws()
+
+    def connect(self):
+        """Create initial connection to Discord gateway"""
+        # gateway url rarely changes, so try cached one first
+        self.gateway_url = self.load_gateway_url()
+        connected = False
+        if self.gateway_url:
+            try:
+                self.connect_ws()
+                connected = True
+            except (websocket._exceptions.WebSocketException, OSError):
+                logger.info("Cached gateway url failed, fetching new one")
+        if not connected:
+            self.gateway_url = self.get_gateway_url()
+            self.save_gateway_url(self.gateway_url)
+            self.connect_ws()
         self.state = 1
-        self.heartbeat_interval = int(json.loads(zlib_decompress(self.ws.recv()))["d"]["heartbeat_interval"])
+        self.heartbeat_interval = int(json.loads(self.zlib_decompress(self.ws.recv()))["d"]["heartbeat_interval"])
         self.receiver_thread = threading.Thread(target=self.safe_function_wrapper, daemon=True, args=(self.receiver, ))
         self.receiver_thread.start()
         self.heartbeat_thread = threading.Thread(target=self.send_heartbeat, daemon=True)
         self.heartbeat_thread.start()
-        self.reconnect_thread = threading.Thread()
         self.authenticate()
 
 
@@ -220,68 +320,214 @@ class Gateway():
         try:
             function(*args)
         except BaseException as e:
-            self.error = "".join(traceback.format_exception(e))
+            self.error = e   # formatted only when read
+            self.update_event.set()
 
 
     def send(self, request):
         """Send data to gateway"""
+        self.send_bytes(json_dumps_bytes(request))
+
+
+    def send_bytes(self, data):
+        """Send already serialized json data to gateway"""
         try:
-            self.ws.send(json.dumps(request))
+            self.ws.send(data, opcode=websocket.ABNF.OPCODE_TEXT)   # bytes are framed as is, without encoding again
         except websocket._exceptions.WebSocketException:
-            self.reconnect_requested = True
+            self.reconnect_event.set()
+
+
+    def set_cork(self, enabled):
+        """Hold back small writes so they are sent in one tcp segment, where supported"""
+        if TCP_CORK is None or not self.ws or not self.ws.sock:
+            return
+        try:
+            self.ws.sock.setsockopt(socket.IPPROTO_TCP, TCP_CORK, int(enabled))
+        except OSError:
+            pass
 
 
     def set_my_user_data(self, data):
         """Set my user data from user object"""
-        tag = None
-        if data.get("primary_guild") and "tag" in data["primary_guild"]:   # spacebar_fix - get
-            tag = data["primary_guild"]["tag"]
-        if data.get("bot"):
+        get = data.get
+        primary_guild = get("primary_guild")   # spacebar_fix - get
+        tag = primary_guild.get("tag") if primary_guild else None
+        bot = get("bot")
+        if bot:
             extra_data = None
         else:
             extra_data = {
                 "avatar": data["avatar"],
-                "avatar_decoration_data": data.get("avatar_decoration_data"),   # spacebar_fix - get
+                "avatar_decoration_data": get("avatar_decoration_data"),   # spacebar_fix - get
                 "discriminator": data["discriminator"],
-                "flags": data.get("flags"),   # spacebar_fix - get
+                "flags": get("flags"),   # spacebar_fix - get
                 "premium_type": data["premium_type"],
             }
         self.my_user_data = {
             "id": data["id"],
             "guild_id": None,
             "username": data["username"],
-            "global_name": data.get("global_name"),   # spacebar_fix - get
+            "global_name": get("global_name"),   # spacebar_fix - get
             "nick": None,
-            "bio": data.get("bio"),
-            "pronouns":  data.get("pronouns"),
+            "bio": get("bio"),
+            "pronouns": get("pronouns"),
             "joined_at": None,
             "tag": tag,
-            "bot": data.get("bot"),
+            "bot": bot,
             "extra": extra_data,
             "roles": None,
         }
         self.user_changed = True
+        self.update_event.set()
 
 
-    def receiver(self):
-        """Receive and handle all traffic from gateway, should be run in a thread"""
-        logger.debug("Receiver started")
-        self.resumable = False
-        while self.run and not self.wait:
+    def handle_heartbeat_ack(self, _response):
+        """Handle opcode 11 - heartbeat ACK"""
+        self.heartbeat_received = True
+
+
+    def handle_hello(self, response):
+        """Handle opcode 10 - hello"""
+        self.heartbeat_interval = int(response["d"]["heartbeat_interval"])
+
+
+    def handle_heartbeat_request(self, _response):
+        """Handle opcode 1 - heartbeat request"""
+        self.send({"op": 1, "d": self.sequence})
+
+
+    def handle_reconnect(self, _response):
+        """Handle opcode 7 - reconnect, stops receiver"""
+        logger.info("Host requested reconnect")
+        print("Host requested reconnect")
+        self.resumable = True
+        return True
+
+
+    def handle_invalid_session(self, response):
+        """Handle opcode 9 - invalid session, stops receiver if session is resumable"""
+        if response["d"]:
+            logger.info("Session invalidated, reconnecting")
+            print("Session invalidated, reconnecting")
+            return True
+        return False
+
+
+    def handle_dispatch(self, response):
+        """Handle opcode 0 - dispatch, by passing event data to its handler"""
+        self.sequence = int(response["s"])
+        handler = self.event_handlers.get(response["t"])
+        if handler:
+            handler(response["d"])
+
+
+    def handle_ready(self, data):
+        """Handle READY event"""
+        self.resume_gateway_url = data["resume_gateway_url"]
+        self.session_id = data["session_id"]
+        self.ready = False
+        self.ready_event.clear()
+        self.my_status = {}
+
+        # get my user data
+        self.set_my_user_data(data["user"])
+        self.my_id = data["user"]["id"]
+        if data.get("auth_token"):
+            self.token_update = data["auth_token"]
+
+        # get user settings
+        if "user_settings_proto" in data and not self.legacy:
+            self.user_settings_proto = decode_settings_proto(data["user_settings_proto"])
+        else:
+            self.legacy = True
+            old_user_settings = data["user_settings"]
+            old_user_settings.update({
+                "status": {
+                    "status": old_user_settings.get("status", "online"),
+                    "guildFolders": {
+                        "guildPositions": old_user_settings.get("guild_positions"),
+                    },
+                },
+            })
+            self.user_settings_proto = old_user_settings
+            if old_user_settings.get("custom_status"):
+                self.user_settings_proto["status"]["customStatus"] = old_user_settings["custom_status"]
+        self.proto_changed = True
+        self.update_event.set()
+
+        self.ready = True
+        self.ready_event.set()
+
+
+    def handle_sessions_replace(self, data):
+        """Handle SESSIONS_REPLACE event, received when new client is connected"""
+        self.my_status = {
+            "activities": [{
+                "type": activity["type"],
+                "name": activity["name"],
+                "state": activity.get("state", ""),
+                "details": activity.get("details", ""),
+                "small_text": double_get(activity, "assets", "small_text"),
+                "large_text": double_get(activity, "assets", "large_text"),
+            } for activity in data[0]["activities"] if activity["type"] in (0, 2)],
+        }
+        self.status_changed = True
+        self.update_event.set()
+
+
+    def handle_user_settings_proto_update(self, data):
+        """Handle USER_SETTINGS_PROTO_UPDATE event, only full proto 1 is used"""
+        if data["partial"] or data["settings"]["type"] != 1:
+            return
+        self.user_settings_proto = decode_settings_proto(data["user_settings_proto"])
+        self.proto_changed = True
+        self.update_event.set()
+
+
+    def reader(self, ws, recv_queue):
+        """
+        Read raw frames from websocket into queue, so socket is drained while receiver is processing, should be run in a thread.
+        None is put when connection is lost, other errors are passed to receiver.
+        """
+        while True:
             try:
-                ws_opcode, data = self.ws.recv_data()
+                frame = ws.recv_data()
             except (
                 ConnectionResetError,
                 websocket._exceptions.WebSocketConnectionClosedException,
                 OSError,
             ):
+                recv_queue.put(None)
+                return
+            except Exception as e:
+                recv_queue.put(e)
+                return
+            recv_queue.put(frame)
+            if frame[0] == 8:   # close frame
+                return
+
+
+    def receiver(self):
+        """Receive and handle all traffic from gateway, should be run in a thread"""
+        logger.debug("Receiver started")
+        self.resumable = False
+        recv_queue = queue.SimpleQueue()
+        threading.Thread(target=self.reader, daemon=True, args=(self.ws, recv_queue)).start()
+        opcode_handlers = self.opcode_handlers
+        is_enabled_for = logger.isEnabledFor
+        while self.run and not self.wait:
+            frame = recv_queue.get()
+            if frame is None:
                 self.resumable = True
                 break
+            if isinstance(frame, Exception):
+                raise frame
+            ws_opcode, data = frame
             if ws_opcode == 8 and len(data) >= 2:
                 if not data:
                     self.resumable = True
                     break
-                status = status_unpacker.unpack(data[0:2])[0]
+                status = status_unpacker.unpack_from(data)[0]
                 reason = data[2:].decode("utf-8", "replace")
                 if status not in (1000, 1001):
                     logger.warning(f"Gateway status code: {status}, reason: {reason}")
@@ -291,7 +537,7 @@ class Gateway():
                 self.resumable = status in (4000, 4009)
                 break
             try:
-                data = zlib_decompress(data)
+                data = self.zlib_decompress(data)
                 if data:
                     try:
                         response = json.loads(data)
@@ -308,157 +554,66 @@ class Gateway():
                 print(f"Receiver error: {e}")
                 self.resumable = True
                 break
-            logger.debug(f"Received: opcode={opcode}, optext={response["t"] if (response and "t" in response and response["t"] and "LIST" not in response["t"]) else 'None'}")
+            if is_enabled_for(logging.DEBUG):
+                optext = response.get("t") if response else None
+                logger.debug(f"Received: opcode={opcode}, optext={optext if (optext and "LIST" not in optext) else 'None'}")
             # debug_events
             # if response.get("t"):
             #     debug.save_json(response, f"{response["t"]}.json", False)
 
-            if opcode == 11:
-                self.heartbeat_received = True
-
-            elif opcode == 10:
-                self.heartbeat_interval = int(response["d"]["heartbeat_interval"])
-
-            elif opcode == 1:
-                self.send({"op": 1, "d": self.sequence})
-
-            elif opcode == 0:
-                self.sequence = int(response["s"])
-                optext = response["t"]
-                data = response["d"]
-                if optext == "READY":
-                    self.resume_gateway_url = data["resume_gateway_url"]
-                    self.session_id = data["session_id"]
-                    self.ready = False
-                    self.my_status = {}
-
-                    # get my user data
-                    self.set_my_user_data(data["user"])
-                    self.my_id = data["user"]["id"]
-                    if data.get("auth_token"):
-                        self.token_update = data["auth_token"]
-
-                    # get user settings
-                    if "user_settings_proto" in data and not self.legacy:
-                        decoded = user_settings_pb2.UserSettings.FromString(base64.b64decode(data["user_settings_proto"]))
-                        self.user_settings_proto = MessageToDict(decoded)
-                    else:
-                        self.legacy = True
-                        old_user_settings = data["user_settings"]
-                        old_user_settings.update({
-                            "status": {
-                                "status": old_user_settings.get("status", "online"),
-                                "guildFolders": {
-                                    "guildPositions": old_user_settings.get("guild_positions"),
-                                },
-                            },
-                        })
-                        self.user_settings_proto = old_user_settings
-                        if old_user_settings.get("custom_status"):
-                            self.user_settings_proto["status"]["customStatus"] = old_user_settings["custom_status"]
-                    self.proto_changed = True
-
-                    # READY is huge so lets save some memory
-                    del (response, data)
-                    data = None
-                    gc.collect()
-
-                    self.ready = True
-
-                elif optext == "SESSIONS_REPLACE":
-                    # received when new client is connected
-                    activities = []
-                    for activity in data[0]["activities"]:
-                        if activity["type"] in (0, 2):
-                            if "assets" in activity:
-                                small_text = activity["assets"].get("small_text")
-                                large_text = activity["assets"].get("large_text")
-                            else:
-                                small_text = None
-                                large_text = None
-                            activities.append({
-                                "type": activity["type"],
-                                "name": activity["name"],
-                                "state": activity.get("state", ""),
-                                "details": activity.get("details", ""),
-                                "small_text": small_text,
-                                "large_text": large_text,
-                            })
-                    self.my_status = {
-                        "activities": activities,
-                    }
-                    self.status_changed = True
-
-                elif optext == "USER_SETTINGS_PROTO_UPDATE":
-                    if data["partial"] or data["settings"]["type"] != 1:
-                        continue
-                    decoded = user_settings_pb2.UserSettings.FromString(base64.b64decode(data["user_settings_proto"]))
-                    self.user_settings_proto = MessageToDict(decoded)
-                    self.proto_changed = True
-
-                elif optext == "USER_UPDATE":
-                    self.set_my_user_data(data)
-
-
-            elif opcode == 7:
-                logger.info("Host requested reconnect")
-                print("Host requested reconnect")
-                self.resumable = True
+            handler = opcode_handlers.get(opcode)
+            if handler and handler(response):
                 break
-
-            elif opcode == 9:
-                if response["d"]:
-                    logger.info("Session invalidated, reconnecting")
-                    print("Session invalidated, reconnecting")
-                    break
+            response = None   # READY is huge, dont keep it while waiting for next message
 
         self.state = 0
         logger.debug("Receiver stopped")
-        self.reconnect_requested = True
+        self.reconnect_event.set()
         self.heartbeat_running = False
+        self.heartbeat_stop.set()
 
 
     def send_heartbeat(self):
         """Send heartbeat to gateway, if response is not received, triggers reconnect, should be run in a thread"""
         logger.debug(f"Heartbeater started, interval={self.heartbeat_interval/1000} s")
         self.heartbeat_running = True
+        self.heartbeat_stop.clear()
         self.heartbeat_received = True
-        # wait for ready event for some time
-        sleep_time = 0
-        while not self.ready:
-            if sleep_time >= self.heartbeat_interval / 100:
-                logger.error("Ready event could not be processed in time, probably because of too many servers. Exiting...")
-                raise SystemExit("Ready event could not be processed in time, probably because of too many servers. Exiting...")
-            time.sleep(0.5)
-            sleep_time += 5
-        heartbeat_interval_rand = int(self.heartbeat_interval * (0.8 - 0.6 * random.random()) / 1000)
-        heartbeat_sent_time = int(time.time())
-        time_spent_event_time = int(time.time()) - 1990   # send it 10s after start, then every 30min
+        # wait for ready event for one heartbeat interval
+        if not self.ready_event.wait(timeout=self.heartbeat_interval / 1000):
+            logger.error("Ready event could not be processed in time, probably because of too many servers. Exiting...")
+            raise SystemExit("Ready event could not be processed in time, probably because of too many servers. Exiting...")
+        if not self.legacy:
+            time_spent_event = json_dumps_bytes({
+                "op": 41,
+                "d": {
+                    "initialization_timestamp": self.init_time,
+                    "session_id": self.client_prop["client_heartbeat_session_id"],
+                    "client_launch_id": self.client_prop["client_launch_id"],
+                },
+            })
+        interval = self.heartbeat_interval / 1000
+        heartbeat_interval_rand = int(interval * (0.8 - 0.6 * random.random()))
+        now = int(time.time())
+        heartbeat_sent_time = now
+        time_spent_event_time = now - 1990   # send it 10s after start, then every 30min
         while self.run and not self.wait and self.heartbeat_running:
-            send_time_spent_event = not self.legacy and int(time.time()) - time_spent_event_time >= 1800
+            now = int(time.time())
+            send_time_spent_event = not self.legacy and now - time_spent_event_time >= 1800
             if send_time_spent_event:
-                self.send({
-                    "op": 41,
-                    "d": {
-                        "initialization_timestamp": self.init_time,
-                        "session_id": self.client_prop["client_heartbeat_session_id"],
-                        "client_launch_id": self.client_prop["client_launch_id"],
-                    },
-                })
+                self.set_cork(True)   # time spent event is followed by heartbeat, send them together
+                self.send_bytes(time_spent_event)
                 logger.debug("Sent Time Spent event")
-                time_spent_event_time = int(time.time())
-            if time.time() - heartbeat_sent_time >= heartbeat_interval_rand or send_time_spent_event:
+                time_spent_event_time = now
+            if now - heartbeat_sent_time >= heartbeat_interval_rand or send_time_spent_event:
                 if QOS_HEARTBEAT and not self.legacy:
-                    self.send({
-                        "op": 1,
-                        "d": {
-                            "seq": self.sequence,
-                            "qos": QOS_PAYLOAD,
-                        },
-                    })
+                    sequence = b"null" if self.sequence is None else str(self.sequence).encode()
+                    self.send_bytes(HEARTBEAT_PREFIX + sequence + HEARTBEAT_SUFFIX)
                 else:
                     self.send({"op": 1, "d": self.sequence})
-                heartbeat_sent_time = int(time.time())
+                if send_time_spent_event:
+                    self.set_cork(False)
+                heartbeat_sent_time = now
                 logger.debug("Sent heartbeat")
                 if not self.heartbeat_received:
                     logger.warning("Heartbeat reply not received")
@@ -466,13 +621,17 @@ class Gateway():
                     self.resumable = True
                     break
                 self.heartbeat_received = False
-                heartbeat_interval_rand = int(self.heartbeat_interval * (0.8 - 0.6 * random.random()) / 1000)
+                heartbeat_interval_rand = int(interval * (0.8 - 0.6 * random.random()))
             # sleep(heartbeat_interval * jitter), but jitter is limited to (0.1 - 0.9)
             # in this time heartbeat ack should be received from discord
-            time.sleep(1)
+            # sleep until next event is due, or heartbeater is stopped
+            next_time = heartbeat_sent_time + heartbeat_interval_rand
+            if not self.legacy:
+                next_time = min(next_time, time_spent_event_time + 1800)
+            self.heartbeat_stop.wait(max(next_time - time.time(), 0))
         self.state = 0
         logger.debug("Heartbeater stopped")
-        self.reconnect_requested = True
+        self.reconnect_event.set()
 
 
     def authenticate(self):
@@ -504,7 +663,7 @@ class Gateway():
         """
         self.ws.close(timeout=0)   # this will stop receiver
         time.sleep(1)   # so receiver ends before opening new socket
-        reset_inflator()   # otherwise decompression wont work
+        self.reset_inflator()   # otherwise decompression wont work
         self.ws = websocket.WebSocket()
         try:
             self.connect_ws(resume=True)
@@ -512,14 +671,14 @@ class Gateway():
             logger.info("Failed to resume connection")
             print("Failed to resume connection")
             return 9
-        _ = zlib_decompress(self.ws.recv())
+        _ = self.zlib_decompress(self.ws.recv())
         payload = {"op": 6, "d": {"token": self.token, "session_id": self.session_id, "seq": self.sequence}}
         self.send(payload)
         try:
-            op = json.loads(zlib_decompress(self.ws.recv()))["op"]
+            op = json.loads(self.zlib_decompress(self.ws.recv()))["op"]
             logger.debug(f"Connection resumed with code {op}")
             return op or True
-        except json.JSONDecodeError:
+        except ValueError:   # JSONDecodeError of all json libraries is subclass of ValueError
             logger.info("Failed to resume connection")
             print("Failed to resume connection")
             return 9
@@ -540,8 +699,9 @@ class Gateway():
                 logger.debug("Restarting connection")
                 self.ws.close(timeout=0)   # this will stop receiver
                 time.sleep(1)   # so receiver ends before opening new socket
-                reset_inflator()   # otherwise decompression wont work
+                self.reset_inflator()   # otherwise decompression wont work
                 self.ready = False   # will receive new ready event
+                self.ready_event.clear()
                 self.ws = websocket.WebSocket()
                 self.connect_ws()
                 self.authenticate()
@@ -554,6 +714,7 @@ class Gateway():
                 self.heartbeat_thread = threading.Thread(target=self.send_heartbeat, daemon=True)
                 self.heartbeat_thread.start()
             self.state = 1
+            self.online_event.set()
             logger.info("Connection established")
             print("Connection established")
         except websocket._exceptions.WebSocketAddressException:
@@ -567,9 +728,11 @@ class Gateway():
     def wait_online(self):
         """Wait for network, try to reconnect every 5s"""
         self.wait = True
+        self.online_event.clear()
         while self.run and self.wait:
-            self.reconnect_requested = True
-            time.sleep(5)
+            self.reconnect_event.set()
+            if self.online_event.wait(timeout=5):
+                break
 
 
     def get_state(self):
@@ -616,7 +779,7 @@ class Gateway():
     def set_offline(self):
         """Set offline client status"""
         # this will trigger reconnect from thread guard
-        self.reconnect_requested = True
+        self.reconnect_event.set()
 
 
     def get_ready(self):
@@ -653,6 +816,13 @@ class Gateway():
         return None
 
 
+    def get_error(self):
+        """Get formatted error that stopped a gateway thread, if any"""
+        if self.error is None:
+            return None
+        return "".join(traceback.format_exception(self.error))
+
+
     def get_token_update(self):
         """Get new refreshed token"""
         cache = self.token_update
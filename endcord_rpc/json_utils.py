@@ -0,0 +1,19 @@
+try:
+    import orjson as json
+except ImportError:
+    try:
+        import ujson as json
+    except ImportError:
+        import json
+import json as json_
+
+if json.__name__ == "orjson":
+    json_dumps_bytes = json.dumps
+elif json.__name__ == "ujson":
+    def json_dumps_bytes(data):
+        """Encode data to compact json bytes"""
+        return json.dumps(data).encode("utf-8")
+else:
+    def json_dumps_bytes(data):
+        """Encode data to compact json bytes"""
+        return json_.dumps(data, separators=(",", ":")).encode("utf-8")
@@ -1,4 +1,3 @@
-import json
 import logging
 import os
 import socket
@@ -8,6 +7,17 @@ import threading
 import time
 import traceback
 
+try:
+    import orjson as json
+except ImportError:
+    try:
+        import ujson as json
+    except ImportError:
+        import json
+import json as json_
+
+from endcord_rpc.json_utils import json_dumps_bytes
+
 if sys.platform == "win32":
     import pywintypes
     import win32file
@@ -16,28 +26,79 @@ if sys.platform == "win32":
 
 GATEWAY_RATE_LIMIT = 5   # delay between each event that rpc server will send to discord
 GATEWAY_RATE_LIMIT_SAME = 60   # delay between each same activity that rpc server will send to discord
-REQUEST_DELAY = 1.5   # delay to decrease error 429 - too many requests
+RPC_SERVER_BACKLOG = 8
+APP_CACHE_TTL = 600   # how long RPC app data and assets are reused for reconnecting clients
+RECEIVE_BUFFER_SIZE = 65536   # discord ipc message buffer size
 logger = logging.getLogger(__name__)
+header_struct = struct.Struct("<II")   # op, length
 if sys.platform == "linux":
-    runtime_dir = os.environ.get("XDG_RUNTIME_DIR", "/run/user/{os.getuid()}")
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or f"/run/user/{os.getuid()}"
     DISCORD_SOCKET = os.path.join(runtime_dir, "discord-ipc-0")
 else:
     DISCORD_SOCKET = ""
 DISCORD_WIN_PIPE = r"\\?\pipe\discord-ipc-0"
-DISCORD_ASSETS_WHITELIST = (   # assets passed from RPC app to discord as text
+DISCORD_ASSETS_WHITELIST = frozenset((   # assets passed from RPC app to discord as text
     "large_text",
     "small_text",
     "large_image",   # external images are text
     "small_image",
-)
-
-
-def receive_data_linux(connection):
+))
+ECHO_TEMPLATE = b'{"cmd":%b,"data":{"evt":%b},"evt":null,"nonce":%b}'
+
+
+
+def pack_echo(op, cmd, evt, nonce):
+    """Pack echo response frame by filling prebuilt json template"""
+    payload = ECHO_TEMPLATE % (json_dumps_bytes(cmd), json_dumps_bytes(evt), json_dumps_bytes(nonce))
+    return header_struct.pack(op, len(payload)) + payload
+
+
+class SocketReader:
+    """Buffered socket reader that receives as much data as available with one syscall"""
+
+    def __init__(self, connection, size=RECEIVE_BUFFER_SIZE):
+        self.connection = connection
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+
+    def receive(self, length):
+        """Receive exactly length bytes, return None if connection is closed before that"""
+        if self.end - self.start < length:
+            # move leftover data to the buffer start, grow buffer only for frames that dont fit
+            pending = self.end - self.start
+            if length > len(self.buffer):
+                buffer = bytearray(length)
+                buffer[:pending] = self.view[self.start:self.end]
+                self.view.release()
+                self.buffer = buffer
+                self.view = memoryview(buffer)
+            elif self.start:
+                self.buffer[:pending] = self.buffer[self.start:self.end]   # copy, regions can overlap
+            self.start = 0
+            self.end = pending
+            while self.end < length:
+                size = self.connection.recv_into(self.view[self.end:])
+                if not size:
+                    return None
+                self.end += size
+        data = bytes(self.view[self.start:self.start + length])
+        self.start += length
+        return data
+
+
+def receive_data_linux(reader):
     """Receive and decode nicely packed json data"""
     try:
-        header = connection.recv(8)
-        op, length = struct.unpack("<II", header)
-        data = connection.recv(length)
+        header = reader.receive(8)
+        if header is None:
+            return None, None
+        op, length = header_struct.unpack(header)
+        data = reader.receive(length)
+        if data is None:
+            return None, None
         final_data = json.loads(data)
         return op, final_data
     except struct.error as e:
@@ -45,63 +106,137 @@ def receive_data_linux(connection):
         return None, None
 
 
-def send_data_linux(connection, op, data):
+def pack_data(op, data):
     """
-    Nicely encode and send json data
+    Nicely encode and pack json data into one frame
     op codes:
     0 - handshake
     1 - payload
     """
-    payload = json.dumps(data, separators=(",", ":"))
-    package = struct.pack("<ii", op, len(payload)) + payload.encode("utf-8")
+    payload = json_dumps_bytes(data)
+    return header_struct.pack(op, len(payload)) + payload
+
+
+def send_raw_linux(connection, package):
+    """Send already packed frame"""
     connection.sendall(package)
 
 
+def send_data_linux(connection, op, data):
+    """Nicely encode and send json data"""
+    connection.sendall(pack_data(op, data))
+
+
 def receive_data_win(pipe):
     """Receive and decode nicely packed json data from windows named pipe"""
     try:
         header = win32file.ReadFile(pipe, 8)[1]
-        op, length = struct.unpack("<II", header)
+        op, length = header_struct.unpack(header)
         data = win32file.ReadFile(pipe, length)[1]
-        final_data = json.loads(data.decode("utf-8"))
+        final_data = json.loads(data)
         return op, final_data
     except (struct.error, pywintypes.error) as e:
         logger.error(e)
         return None, None
 
 
-def send_data_win(pipe, op, data):
-    """
-    Nicely encode and send json data to windows named pipe
-    op codes:
-    0 - handshake
-    1 - payload
-    """
+def send_raw_win(pipe, package):
+    """Send already packed frame to windows named pipe"""
     try:
-        payload = json.dumps(data, separators=(",", ":"))
-        package = struct.pack("<ii", op, len(payload)) + payload.encode("utf-8")
         win32file.WriteFile(pipe, package)
     except pywintypes.error as e:
         logger.error(e)
 
 
+def send_data_win(pipe, op, data):
+    """Nicely encode and send json data to windows named pipe"""
+    send_raw_win(pipe, pack_data(op, data))
+
+
 if sys.platform == "win32":
     receive_data = receive_data_win
     send_data = send_data_win
+    send_raw = send_raw_win
 else:
     receive_data = receive_data_linux
     send_data = send_data_linux
+    send_raw = send_raw_linux
+
+
+class ActivityLimiter:
+    """Rate limiter for activities from one RPC client, latest limited activity is published when limit expires"""
+
+    def __init__(self, publish):
+        self.publish = publish
+        self.lock = threading.Lock()
+        self.sent_time = time.monotonic() - (GATEWAY_RATE_LIMIT + 1)
+        self.prev_activity = None
+        self.pending = None   # (activity, activity_raw)
+        self.timer = None
+
+
+    def update(self, activity):
+        """Publish activity now and return True, or return False if it is rate limited"""
+        activity_raw = json_dumps_bytes(activity)   # activity is modified when published
+        with self.lock:
+            self.cancel()
+            now = time.monotonic()
+            if activity_raw == self.prev_activity:
+                if now - self.sent_time < GATEWAY_RATE_LIMIT_SAME:
+                    return False   # already published
+            elif now - self.sent_time < GATEWAY_RATE_LIMIT:
+                self.pending = (activity, activity_raw)
+                self.timer = threading.Timer(self.sent_time + GATEWAY_RATE_LIMIT - now, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+                return False
+            self.prev_activity = activity_raw
+            self.sent_time = now
+            self.publish(activity)
+            return True
+
+
+    def flush(self):
+        """Publish pending rate limited activity"""
+        with self.lock:
+            if self.pending is None:
+                return
+            activity, self.prev_activity = self.pending
+            self.pending = None
+            self.timer = None
+            self.sent_time = time.monotonic()
+            try:
+                self.publish(activity)
+            except Exception as e:
+                logger.error("".join(traceback.format_exception(e)))
+
+
+    def cancel(self):
+        """Drop pending activity, must be called with lock held"""
+        self.pending = None
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+
+    def close(self):
+        """Drop pending activity so nothing is published after client disconnects"""
+        with self.lock:
+            self.cancel()
 
 
 class RPC:
     """Main RPC class"""
 
-    def __init__(self, discord, user, config):
+    def __init__(self, discord, user, config, update_event=None):
         self.discord = discord
         self.changed = False
+        self.update_event = update_event or threading.Event()   # set when activities change
         self.external = config["rpc_external"]
-        self.activities = []
+        self.activities = {}   # {app_id: activity}
+        self.activity_hashes = {}   # {app_id: hash of encoded activity}
         self.not_exist = []
+        self.app_cache = {}   # {app_id: (expire_time, rpc_data, assets_by_name)}
         if user["bot"]:
             logger.warning("RPC server cannot be started for bot accounts")
             return
@@ -147,36 +282,121 @@ class RPC:
             "evt": "READY",
             "nonce": None,
         }
+        self.dispatch_frame = pack_data(1, self.dispatch)   # same for every client
 
 
     def build_response(self, data):
-        """Build response to RPC client, which is usually just echo"""
-        if data["cmd"] == "SET_ACTIVITY":
-            response = {
-                "cmd": data["cmd"],
-                "data": data["args"]["activity"],
-                "evt": None,
-                "nonce": data["nonce"],
-            }
-        else:
-            response = {
-                "cmd": data["cmd"],
-                "data": {
-                    "evt": data["evt"],
-                },
-                "evt": None,
-                "nonce": data["nonce"],
-            }
-        return response
+        """Build response to RPC client SET_ACTIVITY command"""
+        return {
+            "cmd": data["cmd"],
+            "data": data["args"]["activity"],
+            "evt": None,
+            "nonce": data["nonce"],
+        }
+
+
+    def get_app_data(self, app_id):
+        """Get RPC app data and its assets by name, cached for reconnecting clients"""
+        cached = self.app_cache.get(app_id)
+        if cached and cached[0] > time.monotonic():
+            return 0, cached[1], cached[2]
+        status, rpc_data = self.discord.get_rpc_app(app_id)
+        if not rpc_data:
+            return status, None, None
+        rpc_assets = self.discord.get_rpc_app_assets(app_id)
+        if not rpc_assets:
+            return status, None, None
+        assets_by_name = {asset["name"]: asset["id"] for asset in rpc_assets}
+        self.app_cache[app_id] = (time.monotonic() + APP_CACHE_TTL, rpc_data, assets_by_name)
+        return status, rpc_data, assets_by_name
+
+
+    def get_external_assets(self, app_id, urls):
+        """Get discord proxied paths for all external asset urls with one request"""
+        for _ in range(5):
+            external_assets = self.discord.get_rpc_app_external(app_id, list(urls.values()))
+            if isinstance(external_assets, float):   # rate limited
+                time.sleep(external_assets + 0.2)
+            elif not external_assets:
+                break
+            else:
+                return {asset_client: f"mp:{asset["external_asset_path"]}" for asset_client, asset in zip(urls, external_assets)}
+        return {}
+
+
+    def set_activity(self, app_id, rpc_data, assets_by_name, activity):
+        """Convert activity received from RPC client and store it"""
+        activity_type = activity.get("type", 0)
+
+        # add everything thats missing
+        activity["application_id"] = app_id
+        if not activity.get("name"):
+            activity["name"] = rpc_data["name"]
+        assets = {}
+        external_urls = {}   # {asset_client: url}
+        activity_assets = activity.get("assets") or {}
+        for asset_client, value in activity_assets.items():
+
+            # check if asset is external link
+            if value.startswith("https://"):
+                external_urls[asset_client] = value
+                continue
+
+            # check if asset is an image
+            elif "image" in asset_client:
+                asset_id = assets_by_name.get(value)
+                if asset_id is not None:
+                    assets[asset_client] = asset_id
+            elif asset_client in DISCORD_ASSETS_WHITELIST:
+                assets[asset_client] = value
+                continue
+
+        if external_urls and self.external:
+            assets.update(self.get_external_assets(app_id, external_urls))
+
+        # prepare other data
+        if "timestamps" in activity:
+            if "start" in activity["timestamps"]:
+                activity["timestamps"]["start"] *= 1000
+            if "end" in activity["timestamps"]:
+                activity["timestamps"]["end"] *= 1000
+        if "buttons" in activity:
+            buttons = activity.pop("buttons")
+            activity["buttons"] = []
+            activity["metadata"] = {"button_urls": []}
+            for button in buttons:
+                activity["buttons"].append(button["label"])
+                activity["metadata"]["button_urls"].append(button["url"])
+
+        activity["assets"] = assets
+        if activity_type == 2:
+            activity.pop("flags", None)
+        activity["flags"] = 1
+        activity["type"] = activity_type
+        activity.pop("instance", None)
+
+        # self.changed will be true only when presence data has been updated
+        activity_hash = hash(json_dumps_bytes(activity))
+        if activity_hash != self.activity_hashes.get(app_id):
+            self.activities[app_id] = activity
+            self.activity_hashes[app_id] = activity_hash
+            self.changed = True
+            self.update_event.set()
 
 
     def client_thread(self, connection):
         """Thread that handles receiving and sending data from one client"""
         app_id = None
         rpc_data = None
+        limiter = None
+
+        if sys.platform == "win32":
+            reader = connection
+        else:
+            reader = SocketReader(connection)
 
         try:   # lets keep server running even if there is error in one thread
-            op, init_data = receive_data(connection)
+            op, init_data = receive_data(reader)
             if op is None or init_data is None:
                 return
             if isinstance(init_data, str):   # discord client sends a number string for unknown reason
@@ -195,123 +415,41 @@ class RPC:
                 return
 
             logger.debug(f"RPC app id: {app_id}")
-            status, rpc_data = self.discord.get_rpc_app(app_id)
-            rpc_assets = self.discord.get_rpc_app_assets(app_id)
-            if rpc_data and rpc_assets:
+            status, rpc_data, assets_by_name = self.get_app_data(app_id)
+            if rpc_data:
                 logger.info(f"RPC client connected: {rpc_data["name"]}")
                 print(f"RPC client connected: {rpc_data["name"]}")
-                send_data(connection, 1, self.dispatch)
-                sent_time = time.time() - (GATEWAY_RATE_LIMIT + 1)
-                prev_activity = None
+                send_raw(connection, self.dispatch_frame)
+                limiter = ActivityLimiter(lambda activity: self.set_activity(app_id, rpc_data, assets_by_name, activity))
+                debug = logger.isEnabledFor(logging.DEBUG)
                 while self.run:
-                    op, data = receive_data(connection)
+                    op, data = receive_data(reader)
                     if not data:
                         break
-                    logger.debug(f"Received: {json.dumps(data, indent=2)}")
-
-                    if data["cmd"] == "SET_ACTIVITY" and "activity" in data["args"]:
-                        # prevent sending presences too often
-                        delay = GATEWAY_RATE_LIMIT_SAME if data["args"]["activity"] == prev_activity else GATEWAY_RATE_LIMIT
-                        if time.time() - sent_time < delay:
-                            response = self.build_response(data)
-                            send_data(connection, op, response)
-                            prev_activity = data["args"]["activity"]
-                            sent_time = time.time()
+                    if debug:
+                        logger.debug("Received: %s", json_.dumps(data, indent=2))
+                    cmd = data["cmd"]
 
-                        activity = data["args"]["activity"]
+                    if cmd == "SET_ACTIVITY":
+                        args = data["args"]
+                        if "activity" not in args:
+                            continue
+                        activity = args["activity"]
                         if not activity:
                             continue
-                        activity_type = activity.get("type", 0)
-
-                        # add everything thats missing
-                        activity["application_id"] = app_id
-                        if not activity.get("name"):
-                            activity["name"] = rpc_data["name"]
-                        assets = {}
-                        for asset_client in activity["assets"]:
-
-                            # check if asset is external link
-                            if activity["assets"][asset_client][:8] == "https://":
-                                if self.external:
-                                    for _ in range(5):
-                                        external_asset = self.discord.get_rpc_app_external(app_id, activity["assets"][asset_client])
-                                        if isinstance(external_asset, float):   # rate limited
-                                            time.sleep(external_asset + 0.2)
-                                        elif not external_asset:
-                                            break
-                                        else:
-                                            assets[asset_client] = f"mp:{external_asset[0]["external_asset_path"]}"
-                                            break
-                                if len(activity["assets"]) > 1:
-                                    time.sleep(REQUEST_DELAY)
-                                else:
-                                    external_asset = activity["assets"][asset_client]
-                                continue
-
-                            # check if asset is an image
-                            elif "image" in asset_client:
-                                for asset_app in rpc_assets:
-                                    if activity["assets"][asset_client] == asset_app["name"]:
-                                        assets[asset_client] = asset_app["id"]
-                                        break
-                            elif asset_client in DISCORD_ASSETS_WHITELIST:
-                                assets[asset_client] = activity["assets"][asset_client]
-                                continue
-
-                        # prepare other data
-                        if "timestamps" in activity:
-                            if "start" in activity["timestamps"]:
-                                activity["timestamps"]["start"] *= 1000
-                            if "end" in activity["timestamps"]:
-                                activity["timestamps"]["end"] *= 1000
-                        if "buttons" in activity:
-                            buttons = activity.pop("buttons")
-                            activity["buttons"] = []
-                            activity["metadata"] = {"button_urls": []}
-                            for button in buttons:
-                                activity["buttons"].append(button["label"])
-                                activity["metadata"]["button_urls"].append(button["url"])
-
-                        activity["assets"] = assets
-                        if activity_type == 2:
-                            activity.pop("flags", None)
-                        activity["flags"] = 1
-                        activity["type"] = activity_type
-                        activity.pop("instance", None)
-
-                        # self.changed will be true only when presence data has been updated
-                        for num, app in enumerate(self.activities):
-                            if app["application_id"] == app_id:
-                                if activity != self.activities[num]:
-                                    self.activities[num] = activity
-                                    self.changed = True
-                                break
+
+                        # prevent sending presences too often, rate limited ones are just echoed back
+                        echo = pack_data(op, self.build_response(data))   # before activity is modified
+                        if limiter.update(activity):
+                            response = self.build_response(data)
+                            send_data(connection, op, response)
                         else:
-                            self.activities.append(activity)
-                            self.changed = True
-
-                        response = {
-                            "cmd": data["cmd"],
-                            "data": data["args"]["activity"],
-                            "evt": None,
-                            "nonce": data["nonce"],
-                        }
-                        send_data(connection, op, response)
-                    elif data["cmd"] == "SET_ACTIVITY":
-                        pass
+                            send_raw(connection, echo)
                     else:
                         # all other commands are currently unimplemented
                         # returning them to client so it can keep running with rich presence only
                         # this will probably create some errors with edge-case clients
-                        response = {
-                            "cmd": data["cmd"],
-                            "data": {
-                                "evt": data["evt"],
-                            },
-                            "evt": None,
-                            "nonce": data["nonce"],
-                        }
-                        send_data(connection, op, response)
+                        send_raw(connection, pack_echo(op, cmd, data["evt"], data["nonce"]))
 
             else:
                 if status == 2:   # not found
@@ -321,12 +459,13 @@ class RPC:
             logger.error("".join(traceback.format_exception(e)))
 
         # remove presence from list
+        if limiter:
+            limiter.close()
         if app_id:
-            for num, app in enumerate(self.activities):
-                if app["application_id"] == app_id:
-                    self.activities.pop(num)
-                    self.changed = True
-                    break
+            self.activity_hashes.pop(app_id, None)
+            if self.activities.pop(app_id, None) is not None:
+                self.changed = True
+                self.update_event.set()
         if sys.platform == "win32":
             win32file.CloseHandle(connection)
         else:
@@ -371,18 +510,26 @@ class RPC:
         except Exception as e:
             logger.error(e)
             return
+        self.server.listen(RPC_SERVER_BACKLOG)
         logger.info("RPC server started")
         print("RPC server started")
+        # clients stay in threads because they do blocking http requests
         while self.run:
-            self.server.listen(1)
-            client, address = self.server.accept()
+            try:
+                client, _ = self.server.accept()
+            except OSError as e:
+                logger.error(e)
+                continue
             threading.Thread(target=self.client_thread, daemon=True, args=(client, )).start()
+        self.server.close()
 
 
     def get_activities(self):
         """Get activities for all connected apps, and if they changed."""
         cache = self.changed
+        activities = list(self.activities.values())
         if self.changed:
             self.changed = False
-            logger.debug(f"Sending: {json.dumps(self.activities, indent=2)}")
-        return self.activities, cache
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Sending: %s", json_.dumps(activities, indent=2))
+        return activities, cache
@@ -3,7 +3,12 @@ import logging
 import os
 import signal
 import sys
-import time
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 os.environ["PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION"] = "python"   # fix for https://github.com/Nuitka/Nuitka/issues/3442
 if sys.platform == "linux":
@@ -31,6 +36,7 @@ DEFAULT_CONFIG = {
   "custom_user_agent": None,
 }
 gateway = None
+game_detection = None
 run = False
 
 # get platform specific paths
@@ -62,16 +68,25 @@ logging.basicConfig(
 )
 
 
+def save_config(config, path):
+    """Save config as indented json"""
+    if orjson:
+        with open(path, "wb") as file:
+            file.write(orjson.dumps(config, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(config, file, indent=2)
+
+
 def main():
     """Main app function"""
-    global gateway, run
+    global gateway, game_detection, run
 
     # load config
     config_file_path = os.path.join(config_path, "config.json")
     if not os.path.exists(config_file_path):
-        with open(config_file_path, "w") as file:
-            json.dump(DEFAULT_CONFIG, file, indent=2)
-    with open(config_file_path, "r") as f:
+        save_config(DEFAULT_CONFIG, config_file_path)
+    with open(config_file_path, "r", encoding="utf-8") as f:
         config = json.load(f)
     host = config.get("custom_host")
     token = config.get("token")
@@ -112,16 +127,17 @@ def main():
     logger.info("Connecting to gateway")
     print("Connecting to gateway")
     discord = Discord(token, host, client_prop, user_agent, proxy=proxy)
-    gateway = Gateway(token, host, client_prop_gateway, user_agent, proxy=proxy)
+    update_event = threading.Event()   # set by gateway, rpc and game detection when there is something new
+    gateway = Gateway(token, host, client_prop_gateway, user_agent, proxy=proxy, cache_path=config_path, update_event=update_event)
     gateway.connect()
-    while not gateway.get_ready():
+    while not gateway.ready_event.wait(timeout=0.2):
         if gateway.error:
-            logger.fatal(f"Gateway error: \n {gateway.error}")
-            print(f"Gateway error: \n {gateway.error}")
-            sys.exit(gateway.error + ERROR_TEXT)
+            error = gateway.get_error()
+            logger.fatal(f"Gateway error: \n {error}")
+            print(f"Gateway error: \n {error}")
+            sys.exit(error + ERROR_TEXT)
         if not gateway.run:
             sys.exit()
-        time.sleep(0.2)
 
     discord_settings = gateway.get_settings_proto()
     # download proto if its not in gateway
@@ -158,22 +174,22 @@ def main():
 
     my_user_data = gateway.get_my_user_data()
     if enable_rpc:
-        rpc = RPC(discord, my_user_data, {"rpc_external": True})
+        rpc = RPC(discord, my_user_data, {"rpc_external": True}, update_event=update_event)
     if enable_game_detection:
-        game_detection = GameDetection(gateway, discord, game_detection_blacklist, config_path, download_delay=download_delay)
+        game_detection = GameDetection(gateway, discord, game_detection_blacklist, config_path, download_delay=download_delay, update_event=update_event)
 
     # perform token update if needed
     new_token = gateway.get_token_update()
     if new_token:
         logger.info("Token has been refreshed")
-        print("Token hsa been refreshed")
+        print("Token has been refreshed")
         config["token"] = new_token
-        with open(config_file_path, "w") as file:
-            json.dump(config, file, indent=2)
+        save_config(config, config_file_path)
     del new_token
 
     # main loop
     while run:
+        update_event.clear()   # cleared before reading, so changes made while processing are not missed
 
         # check gateway state
         gateway_state = gateway.get_state()
@@ -221,48 +237,29 @@ def main():
             rpc.generate_dispatch(new_user_data)
 
 
-        # send new rpc activities
-        if enable_rpc:
-            rpc_activities, changed = rpc.get_activities()
-            if changed and gateway_state == 1:
-                if enable_game_detection:
-                    game_activities, _ = game_detection.get_activities()
-                    rpc_apps_ids = [d["application_id"] for d in rpc_activities]
-                    my_activities = rpc_activities + [d for d in game_activities if d["application_id"] not in rpc_apps_ids]
-                else:
-                    my_activities = rpc_activities
-                gateway.update_presence(
-                    my_status["status"],
-                    custom_status=my_status["custom_status"],
-                    custom_status_emoji=my_status["custom_status_emoji"],
-                    activities=my_activities,
-                    afk=True,   # so other clients can receive notifications
-                )
-
-        # send new detectable games activities
-        if enable_game_detection:
-            game_activities, changed = game_detection.get_activities()
-            if changed and gateway_state == 1:
-                if enable_rpc:
-                    rpc_activities, _ = rpc.get_activities()
-                    rpc_apps_ids = [d["application_id"] for d in rpc_activities]
-                    my_activities = rpc_activities + [d for d in game_activities if d["application_id"] not in rpc_apps_ids]
-                else:
-                    my_activities = game_activities
-                gateway.update_presence(
-                    my_status["status"],
-                    custom_status=my_status["custom_status"],
-                    custom_status_emoji=my_status["custom_status_emoji"],
-                    activities=my_activities,
-                    afk=True,   # so other clients can receive notifications
-                )
+        # send new rpc and detectable games activities in one presence update
+        rpc_activities, rpc_changed = rpc.get_activities() if enable_rpc else ([], False)
+        game_activities, game_changed = game_detection.get_activities() if enable_game_detection else ([], False)
+        if (rpc_changed or game_changed) and gateway_state == 1:
+            rpc_apps_ids = {d["application_id"] for d in rpc_activities}
+            my_activities = rpc_activities + [d for d in game_activities if d["application_id"] not in rpc_apps_ids]
+            gateway.update_presence(
+                my_status["status"],
+                custom_status=my_status["custom_status"],
+                custom_status_emoji=my_status["custom_status_emoji"],
+                activities=my_activities,
+                afk=True,   # so other clients can receive notifications
+            )
 
         # check gateway for errors
         if gateway.error:
-            print(f"Gateway error: \n {gateway.error}")
-            sys.exit(gateway.error + ERROR_TEXT)
+            error = gateway.get_error()
+            print(f"Gateway error: \n {error}")
+            if game_detection:
+                game_detection.stop()
+            sys.exit(error + ERROR_TEXT)
 
-        time.sleep(0.1)   # some reasonable delay
+        update_event.wait(timeout=1)   # also wake up regularly, to catch gateway state changes
     run = False
 
 
@@ -271,6 +268,8 @@ def sigint_handler(_signum, _frame):
     global gateway, run
     if gateway:
         gateway.disconnect_ws()
+    if game_detection:
+        game_detection.stop()
     run = False
     sys.exit(0)
 